@@ -0,0 +1,261 @@
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from data_utils import SUBJECTS, current_student, current_units, enrich_results, subscribe_results, sync_results
+from perf import traced
+
+UNIT_KEY = ["subject", "lesson_type", "test_number"]
+# 教科ごとの時系列の並び（同じ日なら回、さらに id の順）
+SERIES_KEY = ["subject_code", "test_date", "test_number", "id"]
+TREND_COLUMNS = ["id", "subject", "subject_code", "lesson_type", "test_number", "test_date", "relative_score"]
+
+# 直近の平均をとる回数
+TREND_WINDOW = 3
+# 指数平滑の span（α = 2 / (span + 1)。直近5回ほどに重みが寄る）
+TREND_SPAN = 5
+# 受けた回数が少ない単元を、この回数分の平均（50）で薄めて評価する
+UNIT_PRIOR_N = 2
+# 復習の目安がこの値未満の単元を「復習したい単元」にする
+REVIEW_THRESHOLD = 50
+
+# 「都道府県③」「工業の種類①」の末尾の丸数字
+_UNIT_NUMBER = re.compile(r"[\s　]*[①-⑳]+$")
+
+
+def unit_groups(unit_name: pd.Series) -> pd.Series:
+    """単元名をまとめ単位にする。戻り値の index は元の行（1行が複数のまとめに入ると重複する）。
+
+    末尾の丸数字を除き（都道府県①〜④ →「都道府県」）、「 / 」で区切られた複合単元は
+    それぞれのまとめに入れる（「漢字 / 文の組み立て」→「漢字」「文の組み立て」）。講座は区別しない。
+    """
+    parts = unit_name.dropna().astype(str).str.split(" / ").explode().str.strip()
+    parts = parts.str.replace(_UNIT_NUMBER, "", regex=True)
+    return parts[parts != ""]
+
+
+def _unit_group_table(units_df: pd.DataFrame) -> tuple:
+    """単元マスタから (回 → まとめ番号 の表, まとめ番号 → 教科・まとめ名 の表) を作る。
+
+    前者は UNIT_KEY + group の表で、1回が複数のまとめに入ると複数行になる。
+    """
+    units = units_df[UNIT_KEY + ["unit_name"]].drop_duplicates(UNIT_KEY).reset_index(drop=True)
+    groups = unit_groups(units["unit_name"])
+    table = units.loc[groups.index, UNIT_KEY].assign(unit_group=groups.to_numpy()).drop_duplicates()
+    labels = table[["subject", "unit_group"]].drop_duplicates().reset_index(drop=True)
+    table = table.merge(labels.reset_index(names="group"), on=["subject", "unit_group"])
+    return table[UNIT_KEY + ["group"]], labels.astype({"subject": str})
+
+
+def _subject_codes(subject: pd.Series) -> np.ndarray:
+    return pd.Categorical(subject, categories=SUBJECTS).codes.astype("int8")
+
+
+def _count_before(keys: tuple, key: tuple) -> int:
+    """SERIES_KEY で並んだ keys のうち、key より前に来る行の数"""
+    s, d, n, i = keys
+    ks, kd, kn, ki = key
+    lo, hi = int(np.searchsorted(s, ks, "left")), int(np.searchsorted(s, ks, "right"))
+    d, n, i = d[lo:hi], n[lo:hi], i[lo:hi]
+    before = (d < kd) | ((d == kd) & ((n < kn) | ((n == kn) & (i < ki))))
+    return int(lo + np.count_nonzero(before))
+
+
+def _key_arrays(df: pd.DataFrame) -> tuple:
+    return (df["subject_code"].to_numpy(), df["test_date"].to_numpy(dtype="datetime64[ns]"),
+            df["test_number"].to_numpy(dtype="int64"), df["id"].to_numpy(dtype="int64"))
+
+
+class TrendAnalytics:
+    """生徒の相対スコアの推移と単元ごとの苦手度。結果キャッシュの変更通知で差分更新する。
+
+    trend は教科ごとに時系列で並べた表で、直近 TREND_WINDOW 回の平均 rolling_mean と
+    指数平滑 ewm を持つ。行が増えたり差し替わったりしたら、その教科のその行から後ろだけを計算し直す。
+    unit_sum / unit_n は (教科, 単元のまとめ) ごとの相対スコアの合計と件数（まとめ番号の配列）で、
+    平均はここから求める。
+    """
+
+    def __init__(self, units_df: pd.DataFrame, units_version: str = None):
+        self.lock = threading.Lock()
+        self.unit_groups, self.group_labels = _unit_group_table(units_df)
+        self.units_version = units_version
+        self.trend = None
+        self.members = None
+        self.unit_sum = self.unit_n = None
+
+    def set_units(self, units_df: pd.DataFrame, units_version: str):
+        """単元マスタが変わったときに単元のまとめを作り直す（推移はそのまま）"""
+        with self.lock:
+            self.unit_groups, self.group_labels = _unit_group_table(units_df)
+            self.units_version = units_version
+            if self.trend is not None:
+                self.members = self._members(self.trend)
+                self.unit_sum, self.unit_n = self._unit_totals(self.members)
+
+    # ─── 推移 ───
+
+    @staticmethod
+    def _trend_rows(rows: pd.DataFrame) -> pd.DataFrame:
+        df = enrich_results(rows)
+        if df.empty:
+            return pd.DataFrame(columns=TREND_COLUMNS)
+        df = df[df["relative_score"].notna()]
+        df = df.assign(subject_code=_subject_codes(df["subject"]), test_date=pd.to_datetime(df["test_date"]))
+        return df[TREND_COLUMNS].sort_values(SERIES_KEY).reset_index(drop=True)
+
+    @staticmethod
+    def _with_trend(df: pd.DataFrame) -> pd.DataFrame:
+        """教科ごとの rolling_mean / ewm を1回の groupby で付ける（df は SERIES_KEY 順）"""
+        if df.empty:
+            return df.assign(rolling_mean=np.nan, ewm=np.nan)
+        g = df.groupby("subject_code", sort=False)["relative_score"]
+        return df.assign(
+            rolling_mean=g.rolling(TREND_WINDOW, min_periods=1).mean().droplevel(0),
+            ewm=g.ewm(span=TREND_SPAN, adjust=False).mean().droplevel(0),
+        )
+
+    def _update_trend(self, add: pd.DataFrame, removed: pd.DataFrame):
+        """add を差し込み removed を除いたうえで、変わった位置から後ろの rolling_mean / ewm を求め直す"""
+        kept = self.trend[~self.trend["id"].isin(removed["id"])]
+        keys = _key_arrays(kept)
+        # 全体を並べ直さず、新しい行を並びの位置に差し込む
+        pos = [_count_before(keys, k) for k in zip(*_key_arrays(add))]
+        order = np.insert(np.arange(len(kept)), pos, np.arange(len(add)) + len(kept))
+        merged = pd.concat([kept, add], ignore_index=True).iloc[order].reset_index(drop=True)
+
+        keys = _key_arrays(merged)
+        x = merged["relative_score"].to_numpy(dtype="float64")
+        rolling = merged["rolling_mean"].to_numpy(dtype="float64", copy=True)
+        ewm = merged["ewm"].to_numpy(dtype="float64", copy=True)
+        # 教科ごとに、変わった行（追加・削除）のうち最も前の位置から後ろだけ
+        changed = pd.concat([add, removed])[SERIES_KEY].sort_values(SERIES_KEY).drop_duplicates("subject_code")
+        for key in zip(*_key_arrays(changed)):
+            start = _count_before(keys, key)
+            first = int(np.searchsorted(keys[0], key[0], "left"))
+            end = int(np.searchsorted(keys[0], key[0], "right"))
+            if start >= end:
+                continue
+            # 直近の平均は、前の TREND_WINDOW - 1 行を含めて求め直す
+            ctx = max(first, start - TREND_WINDOW + 1)
+            window = pd.Series(x[ctx:end]).rolling(TREND_WINDOW, min_periods=1).mean()
+            rolling[start:end] = window.to_numpy()[start - ctx:]
+            # 1つ前の ewm を初期値にして続きから平滑化する
+            seed = x[start:end] if start == first else np.concatenate([[ewm[start - 1]], x[start:end]])
+            smoothed = pd.Series(seed).ewm(span=TREND_SPAN, adjust=False).mean().to_numpy()
+            ewm[start:end] = smoothed if start == first else smoothed[1:]
+        self.trend = merged.assign(rolling_mean=rolling, ewm=ewm)
+
+    # ─── 単元のまとめ ───
+
+    def _members(self, trend: pd.DataFrame) -> pd.DataFrame:
+        """結果1行を、その回の単元が入るまとめごとの行に分けた表（id, group, relative_score）"""
+        df = trend[["id"] + UNIT_KEY + ["relative_score"]].merge(self.unit_groups, on=UNIT_KEY, how="inner")
+        return df[["id", "group", "relative_score"]]
+
+    def _unit_totals(self, members: pd.DataFrame) -> tuple:
+        group = members["group"].to_numpy(dtype="int64")
+        size = len(self.group_labels)
+        return (np.bincount(group, weights=members["relative_score"].to_numpy(dtype="float64"), minlength=size),
+                np.bincount(group, minlength=size))
+
+    def _update_units(self, add: pd.DataFrame, removed_ids):
+        gone = self.members["id"].isin(removed_ids).to_numpy()
+        if gone.any():
+            rel_sum, rel_n = self._unit_totals(self.members[gone])
+            self.unit_sum, self.unit_n = self.unit_sum - rel_sum, self.unit_n - rel_n
+        new = self._members(add)
+        rel_sum, rel_n = self._unit_totals(new)
+        self.members = pd.concat([self.members[~gone], new], ignore_index=True)
+        self.unit_sum, self.unit_n = self.unit_sum + rel_sum, self.unit_n + rel_n
+
+    # ─── 結果キャッシュからの通知 ───
+
+    @traced("analytics.on_reset")
+    def on_reset(self, frame: pd.DataFrame):
+        with self.lock:
+            self.trend = self._with_trend(self._trend_rows(frame))
+            self.members = self._members(self.trend)
+            self.unit_sum, self.unit_n = self._unit_totals(self.members)
+
+    @traced("analytics.on_merge")
+    def on_merge(self, new: pd.DataFrame):
+        with self.lock:
+            if self.trend is None:
+                return
+            add = self._trend_rows(new).assign(rolling_mean=np.nan, ewm=np.nan)
+            removed = self.trend[self.trend["id"].isin(new["id"])]
+            self._update_trend(add, removed)
+            self._update_units(add, new["id"])
+
+    @traced("analytics.on_drop")
+    def on_drop(self, ids):
+        with self.lock:
+            if self.trend is None:
+                return
+            removed = self.trend[self.trend["id"].isin(ids)]
+            if not removed.empty:
+                self._update_trend(self.trend.iloc[:0], removed)
+                self._update_units(self.trend.iloc[:0], ids)
+
+    # ─── 読み出し ───
+
+    def subject_trends(self) -> pd.DataFrame:
+        """教科ごとの最新の相対スコア・直近の平均・指数平滑と、1回前の値（delta 用）。教科の順"""
+        with self.lock:
+            trend = self.trend
+        if trend.empty:
+            return pd.DataFrame(columns=["subject", "count", "relative_score", "rolling_mean", "ewm",
+                                         "prev_rolling_mean", "prev_ewm"])
+        g = trend.groupby("subject_code", sort=True)
+        last, prev = g.nth(-1).set_index("subject_code"), g.nth(-2).set_index("subject_code")
+        return pd.DataFrame({
+            "subject": last["subject"].astype(str),
+            "count": g.size(),
+            "relative_score": last["relative_score"],
+            "rolling_mean": last["rolling_mean"],
+            "ewm": last["ewm"],
+            "prev_rolling_mean": prev["rolling_mean"],
+            "prev_ewm": prev["ewm"],
+        }).reset_index(drop=True)
+
+    def units_to_review(self, threshold: float = REVIEW_THRESHOLD, limit: int = None) -> pd.DataFrame:
+        """復習の目安 review_score が threshold 未満の単元のまとめ（低い順）。
+
+        review_score は単元の相対スコアの平均を、UNIT_PRIOR_N 回分の 50 と合わせて平均したもの。
+        1回だけ低かった単元より、何度も低い単元が上に来る。
+        """
+        with self.lock:
+            labels, rel_sum, rel_n = self.group_labels, self.unit_sum, self.unit_n
+        taken = rel_n > 0
+        rel_sum, rel_n = rel_sum[taken], rel_n[taken]
+        units = pd.DataFrame({
+            "subject": labels["subject"].to_numpy()[taken],
+            "unit_group": labels["unit_group"].to_numpy()[taken],
+            "count": rel_n.astype(int),
+            "avg_relative": rel_sum / rel_n,
+            "review_score": (rel_sum + UNIT_PRIOR_N * 50) / (rel_n + UNIT_PRIOR_N),
+        })
+        units = units[units["review_score"] < threshold].sort_values(["review_score", "subject"], kind="stable")
+        return units.head(limit).reset_index(drop=True) if limit else units.reset_index(drop=True)
+
+
+@st.cache_resource
+def _trend_analytics(student_id: str) -> TrendAnalytics:
+    analytics = TrendAnalytics(*current_units())
+    subscribe_results(analytics, student_id)
+    return analytics
+
+
+def get_trend_analytics(student_id: str = None) -> TrendAnalytics:
+    """生徒（省略時はこのセッションの生徒）の結果を同期したうえで、推移と単元の集計を返す"""
+    student_id = student_id or current_student()
+    analytics = _trend_analytics(student_id)
+    units, version = current_units()
+    if version != analytics.units_version:
+        analytics.set_units(units, version)
+    # 同期で差分が届けば on_merge で更新される
+    sync_results(student_id)
+    return analytics
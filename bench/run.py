@@ -0,0 +1,263 @@
+"""ホットパスのベンチマーク。
+
+    python bench/run.py --sizes 1000 100000 1000000
+    python bench/run.py --json bench_result.json
+    python bench/run.py --baseline bench_result.json --tolerance 0.3
+
+計算系（enrich_results / 単元引き当て / 苦手分析の集計 / クラス内順位 / 推移の集計 / グラフ作成）は
+合成データを直接渡して計測し、ページの再実行は SQLite の保存先に書き込んだ
+データで Streamlit の AppTest を使って計測する（データは n 行を複数の生徒に分け、
+ページは既定の生徒の分を表示する）。各項目の実行時間（最小・中央値）と
+ピークメモリ（tracemalloc）を表示する。起動時間は、ページごとに新しいプロセスで
+初回の再実行（import を含む）を計測し、読み込みが STARTUP_BUDGET_SEC を超えたページを示す。
+--baseline を渡すと、中央値が許容幅を超えて遅くなった項目があれば終了コード 1 で終わる。
+"""
+import argparse
+import gc
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+import streamlit as st
+
+from bench.synthetic import load_unit_keys, make_results, write_sqlite
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = ["pages/1_入力.py", "pages/2_グラフ.py", "pages/4_苦手分析.py"]
+STARTUP_PAGES = ["app.py", "pages/1_入力.py", "pages/2_グラフ.py", "pages/3_単元一覧.py",
+                 "pages/4_苦手分析.py", "pages/5_一括入出力.py"]
+
+# 新しいプロセスでページを1回実行し、(初回の実行秒, 重い import の秒) を JSON で出す。
+# streamlit 本体はサーバーが先に読み込んでいるので計測に含めない。
+_STARTUP_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {base!r})
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+at = AppTest.from_file({page!r}, default_timeout=600).run()
+first = time.perf_counter() - start
+import bootstrap
+imports = sum(r["秒"] for r in bootstrap.import_stats().values())
+print(json.dumps({{"first_s": first, "import_s": imports,
+                  "error": str(at.exception[0].value) if at.exception else None}}))
+"""
+
+
+def measure(fn, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    # メモリ計測は時間計測とは別の1回で行う（tracemalloc 自体が遅いため）
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"min_s": min(times), "median_s": statistics.median(times), "peak_mb": peak / 2**20}
+
+
+def bench_compute(n: int, repeat: int) -> dict:
+    import data_utils
+    from analytics import TrendAnalytics
+    from charts import build_trend_figures, x_labels
+    from cohort import CohortRanking
+    from weakness import WeaknessAggregates
+
+    raw = make_results(n)
+    units = data_utils.load_units()
+    results = {}
+
+    results["enrich_results"] = measure(lambda: data_utils.enrich_results(raw), repeat)
+
+    keys = raw[["subject", "lesson_type", "test_number"]].head(1000).itertuples(index=False)
+    keys = list(keys)
+
+    results["unit index build"] = measure(lambda: data_utils._UnitIndex(units), repeat)
+
+    def lookups():
+        for k in keys:
+            data_utils.get_units_for_test(*k)
+    results["get_units_for_test x1000"] = measure(lookups, repeat)
+
+    def weakness_full():
+        agg = WeaknessAggregates(units)
+        agg.on_reset(raw)
+        agg.subject_stats()
+        agg.weak_tests(48)
+    results["weakness full build"] = measure(weakness_full, repeat)
+
+    agg = WeaknessAggregates(units)
+    agg.on_reset(raw)
+    delta = make_results(4, seed=1).assign(id=lambda d: d["id"] + n)
+    results["weakness delta (4 rows)"] = measure(lambda: agg.on_merge(delta), repeat)
+
+    # クラス内順位は生徒を分けたデータで測る（1人あたり単元マスタの回数分）
+    class_raw = data_utils._apply_schema(make_results(n, students=-(-n // len(load_unit_keys()))),
+                                         data_utils.RESULT_SCHEMA)
+
+    def cohort_full():
+        CohortRanking().on_reset(class_raw)
+    results["cohort ranking full build"] = measure(cohort_full, repeat)
+
+    ranking = CohortRanking()
+    ranking.on_reset(class_raw)
+    changed = class_raw.head(4).assign(score=0.0)
+    results["cohort ranking delta (4 rows)"] = measure(lambda: ranking.on_merge(changed), repeat)
+
+    def trend_full():
+        analytics = TrendAnalytics(units)
+        analytics.on_reset(raw)
+        analytics.subject_trends()
+        analytics.units_to_review()
+    results["trend analytics full build"] = measure(trend_full, repeat)
+
+    analytics = TrendAnalytics(units)
+    analytics.on_reset(raw)
+    # 新しい日付の4行（各教科の末尾に付く）
+    latest = make_results(4, seed=2).assign(id=lambda d: d["id"] + 2 * n, test_date=raw["test_date"].max())
+    results["trend analytics delta (4 rows)"] = measure(lambda: analytics.on_merge(latest), repeat)
+
+    enriched = data_utils.enrich_results(raw)
+    enriched["x_label"] = x_labels(enriched)
+    enriched = enriched.sort_values(["test_date", "test_number"])
+    counter = iter(range(10**9))
+    results["trend figures"] = measure(
+        lambda: build_trend_figures(enriched, next(counter), "relative_score", "相対スコア",
+                                    tuple(data_utils.LESSON_TYPES), True),
+        repeat,
+    )
+    return results
+
+
+def bench_pages(n: int, repeat: int, workdir: str) -> dict:
+    from streamlit.testing.v1 import AppTest
+
+    path = os.path.join(workdir, f"bench_{n}.sqlite3")
+    # 1人あたりは単元マスタの回数分で、n が増えると生徒数が増える
+    students = -(-n // len(load_unit_keys()))
+    stored = write_sqlite(path, make_results(n, students=students))
+    os.environ["JUKU_STORAGE_BACKEND"] = "sqlite"
+    os.environ["JUKU_SQLITE_PATH"] = path
+    results = {}
+    for page in PAGES:
+        st.cache_data.clear()
+        st.cache_resource.clear()
+        name = os.path.basename(page)
+
+        def rerun():
+            at = AppTest.from_file(os.path.join(BASE_DIR, page), default_timeout=600).run()
+            if at.exception:
+                raise RuntimeError(f"{page}: {at.exception[0].value}")
+
+        start = time.perf_counter()
+        rerun()
+        cold = time.perf_counter() - start
+        results[f"page {name} (cold)"] = {"min_s": cold, "median_s": cold, "peak_mb": float("nan")}
+        results[f"page {name} (warm)"] = measure(rerun, repeat)
+    results["_stored_rows"] = stored
+    return results
+
+
+def bench_startup(repeat: int, workdir: str) -> dict:
+    from bootstrap import STARTUP_BUDGET_SEC
+
+    # ページ計測の DB とは別に、1人分のデータを入れた DB を子プロセスに渡す
+    path = os.path.join(workdir, "bench_startup.sqlite3")
+    write_sqlite(path, make_results(len(load_unit_keys())))
+    env = dict(os.environ, JUKU_STORAGE_BACKEND="sqlite", JUKU_SQLITE_PATH=path)
+    results = {}
+    for page in STARTUP_PAGES:
+        script = _STARTUP_SCRIPT.format(base=BASE_DIR, page=os.path.join(BASE_DIR, page))
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                                 check=True, env=env)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+            if runs[-1]["error"]:
+                raise RuntimeError(f"{page}: {runs[-1]['error']}")
+        first = [r["first_s"] for r in runs]
+        name = os.path.basename(page)
+        results[f"startup {name}"] = {"min_s": min(first), "median_s": statistics.median(first),
+                                      "peak_mb": float("nan")}
+        imports = statistics.median(r["import_s"] for r in runs)
+        if imports > STARTUP_BUDGET_SEC:
+            results.setdefault("_over_budget", []).append((name, imports))
+    results["_budget"] = STARTUP_BUDGET_SEC
+    return results
+
+
+def main(argv=None) -> int:
+    # 計算系の計測中に単元マスタの裏取得が Supabase を見に行かないようにする
+    os.environ.setdefault("JUKU_STORAGE_BACKEND", "sqlite")
+    os.environ.setdefault("JUKU_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "juku_bench.sqlite3"))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-pages", action="store_true", help="AppTest によるページ計測を省く")
+    parser.add_argument("--skip-startup", action="store_true", help="起動時間の計測を省く")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    parser.add_argument("--baseline", help="比較する過去の JSON")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="許容する中央値の悪化率")
+    args = parser.parse_args(argv)
+
+    report = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in args.sizes:
+            rows = bench_compute(n, args.repeat)
+            if not args.skip_pages:
+                rows.update(bench_pages(n, args.repeat, workdir))
+            stored = rows.pop("_stored_rows", None)
+            report[str(n)] = rows
+            print(f"\n=== {n:,} rows" + (f"（保存先には一意キー {stored:,} 行）" if stored is not None else ""))
+            for name, r in rows.items():
+                print(f"{name:<32} min {r['min_s'] * 1000:9.1f} ms   median {r['median_s'] * 1000:9.1f} ms"
+                      f"   peak {r['peak_mb']:8.1f} MB")
+
+        over_budget = []
+        if not args.skip_startup:
+            rows = bench_startup(args.repeat, workdir)
+            over_budget = rows.pop("_over_budget", [])
+            budget = rows.pop("_budget")
+            report["startup"] = rows
+            print(f"\n=== 起動（新しいプロセスでの初回の実行。読み込みの目安 {budget:.1f} 秒）")
+            for name, r in rows.items():
+                print(f"{name:<32} min {r['min_s'] * 1000:9.1f} ms   median {r['median_s'] * 1000:9.1f} ms")
+            for name, seconds in over_budget:
+                print(f"読み込みが目安を超えた: {name}: {seconds:.2f} 秒")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = [
+            (size, name, base["median_s"], report[size][name]["median_s"])
+            for size, rows in baseline.items() if size in report
+            for name, base in rows.items() if name in report[size]
+            if report[size][name]["median_s"] > base["median_s"] * (1 + args.tolerance)
+        ]
+        for size, name, before, after in regressions:
+            print(f"遅くなった: {size} rows / {name}: {before * 1000:.1f} ms → {after * 1000:.1f} ms")
+        if regressions:
+            return 1
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
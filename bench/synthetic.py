@@ -0,0 +1,87 @@
+"""ベンチマーク用の test_results を合成する"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_utils import DEFAULT_STUDENT_ID, LESSON_TYPES
+from storage import UNITS_CSV
+
+# 講座種別ごとの実施月（年内の並び順を日付に反映する）
+_LESSON_MONTH = {"通常": 4, "春期": 3, "夏期": 8, "冬期": 12}
+
+
+def load_unit_keys(path: str = UNITS_CSV) -> pd.DataFrame:
+    units = pd.read_csv(path)
+    return units[["subject", "lesson_type", "test_number"]].drop_duplicates().reset_index(drop=True)
+
+
+def make_results(n: int, seed: int = 0, keys: pd.DataFrame = None, students: int = None) -> pd.DataFrame:
+    """単元マスタの (subject, lesson_type, test_number) を使って n 行の結果を作る。
+
+    students を省くと全行が既定の生徒で、キーは重複しうる（複数年分の履歴を想定）。
+    students を渡すと、各生徒がすべてのキーを1回ずつ受けた形で先頭の生徒から埋めるので、
+    (student_id, キー) は重複しない（n が students × キー数を超える分は重複する）。
+    生徒 0 は DEFAULT_STUDENT_ID。
+    """
+    rng = np.random.default_rng(seed)
+    keys = load_unit_keys() if keys is None else keys
+    if students is None:
+        picked = keys.iloc[rng.integers(0, len(keys), n)].reset_index(drop=True)
+        student_id = np.full(n, DEFAULT_STUDENT_ID, dtype=object)
+    else:
+        # 生徒ごとにキーの並びを変えて、途中で切れても偏らないようにする
+        order = np.argsort(rng.random((students, len(keys))), axis=1).ravel()
+        idx = np.resize(order, n)
+        picked = keys.iloc[idx].reset_index(drop=True)
+        student_no = (np.arange(n) // len(keys)) % students
+        names = np.array([DEFAULT_STUDENT_ID] + [f"s{i:05d}" for i in range(1, students)], dtype=object)
+        student_id = names[student_no]
+
+    years = rng.integers(0, max(1, n // (len(keys) * 4) + 1), n)
+    month = picked["lesson_type"].map(_LESSON_MONTH).to_numpy()
+    days = month * 30 + picked["test_number"].to_numpy() % 30
+    test_date = pd.Timestamp("2020-01-01") + pd.to_timedelta(years * 365 + days, unit="D")
+
+    max_score = rng.choice([100.0, 100.0, 100.0, 150.0, 200.0], n)
+    average = np.round(max_score * rng.normal(0.6, 0.08, n).clip(0.2, 0.95) * 2) / 2
+    score = np.round((average + rng.normal(0, max_score * 0.15)).clip(0, max_score))
+    std_dev = np.where(rng.random(n) < 0.3, np.round(max_score * rng.uniform(0.1, 0.2, n), 1), np.nan)
+
+    return pd.DataFrame({
+        "id": np.arange(1, n + 1),
+        "student_id": student_id,
+        "test_date": test_date,
+        "lesson_type": pd.Categorical(picked["lesson_type"], categories=LESSON_TYPES).astype(str),
+        "test_number": picked["test_number"].to_numpy(),
+        "subject": picked["subject"].to_numpy(),
+        "score": score,
+        "average_score": average,
+        "max_score": max_score,
+        "std_dev": std_dev,
+        "memo": "",
+    })
+
+
+def write_sqlite(path: str, df: pd.DataFrame, batch: int = 5000) -> int:
+    """SQLite の保存先に結果を書き込み、書き込めた行数を返す。
+
+    保存先は (student_id, lesson_type, test_number, subject) で一意なので、
+    重複するキーは後勝ちで1行にまとまる。
+    """
+    from storage import SQLiteBackend
+    from data_utils import RESULT_KEY, _result_record
+
+    if os.path.exists(path):
+        os.remove(path)
+    backend = SQLiteBackend(path)
+    records = {}
+    for row in df.drop(columns=["id"]).to_dict("records"):
+        rec = _result_record(**{**row, "test_date": row["test_date"].date(),
+                                "std_dev": None if pd.isna(row["std_dev"]) else row["std_dev"]})
+        records[tuple(rec[k] for k in RESULT_KEY)] = rec
+    records = list(records.values())
+    for start in range(0, len(records), batch):
+        backend.upsert_results(records[start:start + batch], RESULT_KEY)
+    backend.conn.close()
+    return len(records)
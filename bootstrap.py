@@ -0,0 +1,68 @@
+"""ページ共通の初期化と、起動時の読み込み時間の計測。
+
+各ページは先頭で setup_page() を呼んでページ設定・共通 CSS・タイトルを先に描き、
+pandas やデータ層などの重いモジュールは deferred_imports() の中で読み込む。
+プロセスの初回（コールドスタート）でも、読み込みを待たずに骨組みが表示される。
+読み込みにかかった時間は処理時間のパネルに出し、STARTUP_BUDGET_SEC を超えたらログで警告する。
+"""
+import logging
+import sys
+import time
+from contextlib import contextmanager
+
+import streamlit as st
+
+import perf
+from settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+# 1ページの初回の読み込みにかけてよい秒数
+STARTUP_BUDGET_SEC = float(get_setting("STARTUP_BUDGET_SEC", 2))
+
+# 全ページ共通：タイトルサイズを小さく
+PAGE_CSS = """
+<style>
+h1 { font-size: 1.6rem !important; }
+</style>
+"""
+
+
+def setup_page(page_title: str, page_icon: str, title: str = None):
+    """ページ設定と共通 CSS を出し、計測を始める。title を渡すとタイトルも描く"""
+    st.set_page_config(page_title=page_title, page_icon=page_icon, layout="wide")
+    st.markdown(PAGE_CSS, unsafe_allow_html=True)
+    perf.begin_rerun()
+    if title:
+        st.title(title)
+
+
+# ページごとの初回の読み込み（ページ → {秒, モジュール数, 予算超過}）
+_import_stats = {}
+
+
+@contextmanager
+def deferred_imports(page: str):
+    """with の中の import にかかった時間を記録する。
+
+    モジュールはプロセスで1回しか読み込まれないので、2回目以降の再実行ではほぼ 0 になる。
+    新しく読み込まれたモジュールがあった回（初回）だけを記録に残す。
+    """
+    before = len(sys.modules)
+    start = time.perf_counter()
+    with perf.span("bootstrap.imports", page=page):
+        yield
+    seconds = time.perf_counter() - start
+    loaded = len(sys.modules) - before
+    if loaded and page not in _import_stats:
+        over = seconds > STARTUP_BUDGET_SEC
+        _import_stats[page] = {"秒": round(seconds, 3), "モジュール数": loaded, "予算超過": over}
+        if over:
+            logger.warning("%s の読み込みに %.2f 秒かかりました（目安 %.1f 秒）", page, seconds, STARTUP_BUDGET_SEC)
+
+
+def import_stats() -> dict:
+    return dict(_import_stats)
+
+
+perf.register_counters("起動時の読み込み（ページごとの初回）", import_stats)
@@ -0,0 +1,256 @@
+"""テスト結果の一括取り込み・書き出し。
+
+    python bulk_io.py import results.csv [--student ID] [--dry-run] [--chunk-size 5000] [--batch-size 500]
+    python bulk_io.py export results.parquet [--student ID ...]
+
+取り込みは CSV / Excel を chunk-size 行ずつ読み、単元マスタに無いキーや不正な値の行を除き、
+(student_id, lesson_type, test_number, subject) が重複する行は後勝ちにして batch-size 行ずつ upsert する。
+student_id 列が無い・空の行は --student（既定は DEFAULT_STUDENT_ID）の生徒として取り込む。
+書き出しは test_results をページ単位で読みながら CSV / Parquet に追記する。
+"""
+import argparse
+import io
+import os
+import sys
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from data_utils import (DEFAULT_STUDENT_ID, LESSON_TYPES, RESULT_KEY, SUBJECTS, add_students,
+                        iter_results, list_students, load_unit_index, upsert_results)
+
+REQUIRED_COLUMNS = ["test_date", "lesson_type", "test_number", "subject",
+                    "score", "average_score", "max_score"]
+OPTIONAL_COLUMNS = ["student_id", "std_dev", "memo"]
+
+# 画面の表示名（1_入力.py の一覧など）でも取り込めるようにする
+COLUMN_ALIASES = {
+    "日付": "test_date", "講座": "lesson_type", "講座種別": "lesson_type",
+    "講義No.": "test_number", "回": "test_number", "教科": "subject",
+    "得点": "score", "平均点": "average_score", "満点": "max_score",
+    "標準偏差": "std_dev", "メモ": "memo", "生徒": "student_id", "生徒ID": "student_id",
+}
+
+# 取り込み結果に残す不正行の件数
+MAX_ERRORS_KEPT = 200
+
+
+@dataclass
+class ImportReport:
+    read: int = 0
+    invalid: int = 0
+    duplicates: int = 0
+    written: int = 0
+    errors: list = field(default_factory=list)   # (行番号, 理由)
+
+    def add_errors(self, lines, reasons):
+        self.invalid += len(lines)
+        room = MAX_ERRORS_KEPT - len(self.errors)
+        if room > 0:
+            self.errors += list(zip(lines[:room], reasons[:room]))
+
+
+def _read_chunks(source, chunk_size: int, name: str = None):
+    name = (name or (source if isinstance(source, str) else getattr(source, "name", ""))).lower()
+    if name.endswith(".xls"):
+        raise ValueError("旧形式の Excel（.xls）には対応していません。.xlsx か CSV で保存し直してください")
+    if name.endswith(".xlsx"):
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError as e:
+            raise RuntimeError("Excel から取り込むには openpyxl が必要です（pip install openpyxl）") from e
+        # Excel は分割して読めないので、読み込んだ後に区切る
+        df = pd.read_excel(source, dtype=str, engine="openpyxl")
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+    else:
+        yield from pd.read_csv(source, dtype=str, chunksize=chunk_size, encoding="utf-8-sig")
+
+
+def _validate(chunk: pd.DataFrame, first_line: int, unit_keys: pd.MultiIndex, student_id: str):
+    """(正しい行, 不正な行の行番号, 理由) を返す。student_id は生徒の列が空の行に使う"""
+    df = chunk.rename(columns=COLUMN_ALIASES)
+    missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"必須の列がありません: {missing}")
+    df = df.reindex(columns=REQUIRED_COLUMNS + OPTIONAL_COLUMNS).reset_index(drop=True)
+
+    test_date = pd.to_datetime(df["test_date"], errors="coerce")
+    nums = {c: pd.to_numeric(df[c], errors="coerce")
+            for c in ["test_number", "score", "average_score", "max_score", "std_dev"]}
+    subject = df["subject"].str.strip()
+    lesson_type = df["lesson_type"].str.strip()
+
+    checks = [
+        (test_date.isna(), "日付が読めません"),
+        (~subject.isin(SUBJECTS), "教科が不明です"),
+        (~lesson_type.isin(LESSON_TYPES), "講座種別が不明です"),
+        (nums["test_number"].isna() | (nums["test_number"] % 1 != 0), "講義No.が整数ではありません"),
+        (nums["score"].isna() | (nums["score"] < 0), "得点が不正です"),
+        (nums["average_score"].isna() | (nums["average_score"] < 0), "平均点が不正です"),
+        (nums["max_score"].isna() | (nums["max_score"] <= 0), "満点が不正です"),
+        (nums["score"] > nums["max_score"], "得点が満点を超えています"),
+        (df["std_dev"].notna() & (nums["std_dev"].isna() | (nums["std_dev"] < 0)), "標準偏差が不正です"),
+    ]
+    reason = pd.Series("", index=df.index)
+    for mask, text in checks:
+        reason = reason.mask(mask.to_numpy() & (reason == ""), text)
+    ok = reason == ""
+    keys = pd.MultiIndex.from_arrays([subject, lesson_type, nums["test_number"].fillna(-1).astype(int)])
+    reason = reason.mask(ok & ~keys.isin(unit_keys), "単元マスタに無い回です")
+    ok = reason == ""
+
+    valid = pd.DataFrame({
+        "student_id": df["student_id"].astype("string").str.strip().replace("", pd.NA).fillna(student_id),
+        "test_date": test_date.dt.date,
+        "lesson_type": lesson_type,
+        "test_number": nums["test_number"].fillna(0).astype(int),
+        "subject": subject,
+        "score": nums["score"],
+        "average_score": nums["average_score"],
+        "max_score": nums["max_score"],
+        "std_dev": nums["std_dev"],
+        "memo": df["memo"].fillna(""),
+    })[ok.to_numpy()]
+    bad = ~ok.to_numpy()
+    # 1行目は見出しなので、データの行番号は2から
+    lines = (np.flatnonzero(bad) + first_line + 2).tolist()
+    return valid, lines, reason[bad].tolist()
+
+
+def import_results(source, name: str = None, chunk_size: int = 5000, batch_size: int = 500,
+                   dry_run: bool = False, on_progress=None, student_id: str = None) -> ImportReport:
+    """CSV / Excel のテスト結果を取り込む。source はパスかファイルオブジェクト。
+
+    未登録の生徒は student_id を名前にして登録する。
+    """
+    unit_keys = pd.MultiIndex.from_tuples(list(load_unit_index().by_key))
+    student_id = student_id or DEFAULT_STUDENT_ID
+    known_students = set(list_students()["student_id"])
+    report = ImportReport()
+    seen = set()
+    for chunk in _read_chunks(source, chunk_size, name):
+        valid, lines, reasons = _validate(chunk, report.read, unit_keys, student_id)
+        report.read += len(chunk)
+        report.add_errors(lines, reasons)
+
+        key_cols = valid[RESULT_KEY]
+        dup_in_chunk = key_cols.duplicated(keep="last")
+        valid = valid[~dup_in_chunk.to_numpy()]
+        keys = list(key_cols[~dup_in_chunk].itertuples(index=False, name=None))
+        # 前のチャンクと重複するキーは、後のチャンクの upsert で上書きされる
+        report.duplicates += int(dup_in_chunk.sum()) + sum(k in seen for k in keys)
+        seen.update(keys)
+
+        if not dry_run:
+            new_students = sorted(set(valid["student_id"]) - known_students)
+            if new_students:
+                add_students([{"student_id": s, "name": s} for s in new_students])
+                known_students.update(new_students)
+            records = valid.to_dict("records")
+            for start in range(0, len(records), batch_size):
+                upsert_results(records[start:start + batch_size], with_status=False)
+        # 重複したキーは上書きなので、書き込んだ行数はキーの数
+        report.written = len(seen)
+        if on_progress:
+            on_progress(report)
+    return report
+
+
+def _export_frame(chunk: pd.DataFrame) -> pd.DataFrame:
+    # チャンクごとに型がぶれないよう、カテゴリー列は文字列にして書く
+    out = chunk.copy()
+    for col in out.columns:
+        if isinstance(out[col].dtype, pd.CategoricalDtype):
+            out[col] = out[col].astype(str)
+    out["test_date"] = out["test_date"].dt.date.astype(str)
+    return out
+
+
+def export_results(target, fmt: str = None, page_size: int = None, max_workers: int = None,
+                   student_id=None) -> int:
+    """test_results を書き出して行数を返す。target はパスかファイルオブジェクト。
+
+    student_id（1つの値かリスト）を渡すとその生徒の分だけ、省略するとクラス全体。
+    行はページの取得順に書かれるため、id 順・日付順とは限らない。
+    """
+    fmt = fmt or os.path.splitext(target)[1].lstrip(".").lower()
+    written = 0
+    if fmt == "csv":
+        # Excel で文字化けしないよう BOM 付きで書く
+        f = open(target, "w", encoding="utf-8-sig", newline="") if isinstance(target, str) else target
+        try:
+            for chunk in iter_results(page_size=page_size, max_workers=max_workers, student_id=student_id):
+                _export_frame(chunk).to_csv(f, header=not written, index=False)
+                written += len(chunk)
+        finally:
+            if isinstance(target, str):
+                f.close()
+    elif fmt == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Parquet で書き出すには pyarrow が必要です（pip install pyarrow）") from e
+        writer = None
+        try:
+            for chunk in iter_results(page_size=page_size, max_workers=max_workers, student_id=student_id):
+                frame = _export_frame(chunk)
+                if writer is None:
+                    schema = pa.Schema.from_pandas(frame, preserve_index=False)
+                    writer = pq.ParquetWriter(target, schema)
+                writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+                written += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        raise ValueError(f"未対応の形式です: {fmt}（csv / parquet）")
+    return written
+
+
+def export_csv_bytes(student_id=None) -> bytes:
+    """ダウンロードボタン用に CSV を作る（BOM 付き UTF-8）"""
+    buf = io.StringIO()
+    export_results(buf, fmt="csv", student_id=student_id)
+    return ("\ufeff" + buf.getvalue()).encode("utf-8")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="テスト結果の一括取り込み・書き出し")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import", help="CSV / Excel から取り込む")
+    p_import.add_argument("path")
+    p_import.add_argument("--chunk-size", type=int, default=5000)
+    p_import.add_argument("--batch-size", type=int, default=500)
+    p_import.add_argument("--student", help="生徒の列が無い行の student_id")
+    p_import.add_argument("--dry-run", action="store_true", help="検証だけ行い書き込まない")
+    p_export = sub.add_parser("export", help="CSV / Parquet に書き出す")
+    p_export.add_argument("path")
+    p_export.add_argument("--page-size", type=int)
+    p_export.add_argument("--workers", type=int)
+    p_export.add_argument("--student", nargs="+", help="書き出す生徒（省略するとクラス全体）")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        report = import_results(
+            args.path, chunk_size=args.chunk_size, batch_size=args.batch_size, dry_run=args.dry_run,
+            student_id=args.student,
+            on_progress=lambda r: print(f"\r{r.read:,} 行読み込み", end="", file=sys.stderr),
+        )
+        print(file=sys.stderr)
+        print(f"読み込み {report.read:,} 行 / 書き込み {report.written:,} 行 / "
+              f"重複 {report.duplicates:,} 行 / 不正 {report.invalid:,} 行"
+              + ("（dry-run）" if args.dry_run else ""))
+        for line, reason in report.errors:
+            print(f"  {line} 行目: {reason}")
+        return 1 if report.invalid else 0
+
+    n = export_results(args.path, page_size=args.page_size, max_workers=args.workers, student_id=args.student)
+    print(f"{n:,} 行を書き出しました: {args.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import streamlit as st
+
+from data_utils import SUBJECTS
+from perf import span
+from settings import get_setting
+
+COLORS = {"国語": "#EF4444", "算数": "#3B82F6", "理科": "#10B981", "社会": "#F59E0B"}
+
+# 1本の線あたりこの点数を超えたら間引く
+CHART_MAX_POINTS = int(get_setting("CHART_MAX_POINTS", 400))
+
+
+def x_labels(df: pd.DataFrame) -> pd.Series:
+    """「通常 第3回」形式の横軸ラベル"""
+    return df["lesson_type"].astype(str) + " 第" + df["test_number"].astype(int).astype(str) + "回"
+
+
+def lttb_indices(y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets で残す点の位置を返す（x は等間隔とみなす）。
+
+    先頭と末尾は必ず残し、間を n_out - 2 個のバケットに分けて、前に残した点と
+    次のバケットの平均点とで作る三角形が最大になる点を各バケットから1つ選ぶ。
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    y = np.nan_to_num(np.asarray(y, dtype="float64"))
+    x = np.arange(n, dtype="float64")
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[hi:nxt_hi].mean(), y[hi:nxt_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        keep[i + 1] = a
+    return keep
+
+
+def _downsample(sub: pd.DataFrame, y_col: str, max_points: int) -> pd.DataFrame:
+    if len(sub) <= max_points:
+        return sub
+    return sub.iloc[lttb_indices(sub[y_col].to_numpy(), max_points)]
+
+
+def _layout(fig: go.Figure, height: int, y_label: str):
+    fig.update_layout(
+        height=height, hovermode="x unified",
+        yaxis_title=y_label, xaxis_title="",
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        margin=dict(t=30, b=10),
+    )
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_trend_figures(_df: pd.DataFrame, version, y_col: str, y_label: str,
+                        lesson_types: tuple, show_avg_line: bool,
+                        max_points: int = CHART_MAX_POINTS) -> dict:
+    """成績グラフページの図（plotly の figure dict）を作る。
+
+    _df は x_label 付き・表示順に並べた結果で、ハッシュはせず version（データの版）と
+    表示設定をキャッシュキーにする。戻り値は "all"（全教科）と教科名がキー。
+    """
+    with span("charts.build_trend_figures", rows=len(_df)):
+        return _build_trend_figures(_df, y_col, y_label, show_avg_line, max_points)
+
+
+# 平均が 50 になる指標（平均ラインは 50 の横線で引く）
+CENTERED_METRICS = {"relative_score", "cohort_deviation", "percentile"}
+
+
+def _build_trend_figures(df, y_col, y_label, show_avg_line, max_points) -> dict:
+    """教科 → 図 と "all"（全教科まとめ）の dict。y_col が欠損しかない教科は含めない"""
+    figures = {}
+    # クラス内の指標は人数が足りない回が欠損になる
+    df = df[df[y_col].notna()]
+
+    fig_all = go.Figure()
+    for subject in SUBJECTS:
+        sub = df[df["subject"] == subject]
+        if sub.empty:
+            continue
+        sub = _downsample(sub, y_col, max_points)
+        fig_all.add_trace(go.Scatter(
+            x=sub["x_label"], y=sub[y_col],
+            mode="lines+markers", name=subject,
+            line=dict(color=COLORS[subject], width=2),
+            marker=dict(size=9),
+            hovertemplate=f"<b>{subject}</b><br>%{{x}}<br>{y_label}: %{{y}}<extra></extra>"
+        ))
+
+        fig = go.Figure()
+        fig.add_trace(go.Scatter(
+            x=sub["x_label"], y=sub[y_col],
+            mode="lines+markers", name=subject,
+            line=dict(color=COLORS[subject], width=3),
+            marker=dict(size=11),
+            hovertemplate=f"<b>{subject}</b><br>%{{x}}<br>{y_label}: %{{y}}<br>得点: %{{customdata[0]}} / %{{customdata[1]}}<extra></extra>",
+            customdata=sub[["score", "max_score"]].values,
+        ))
+        # 平均ラインを得点率・得点モードで追加（間引きは本線と同じ点で揃える）
+        avg_col = {"score_rate": "avg_rate", "score": "average_score"}.get(y_col)
+        if show_avg_line and avg_col:
+            fig.add_trace(go.Scatter(
+                x=sub["x_label"], y=sub[avg_col],
+                mode="lines+markers", name="平均",
+                line=dict(color="#9CA3AF", width=2, dash="dash"),
+                marker=dict(size=7),
+            ))
+        elif y_col in CENTERED_METRICS and show_avg_line:
+            fig.add_hline(y=50, line_dash="dot", line_color="gray", annotation_text="平均(50)")
+        _layout(fig, 320, y_label)
+        figures[subject] = fig.to_dict()
+
+    if y_col in CENTERED_METRICS and show_avg_line:
+        fig_all.add_hline(y=50, line_dash="dot", line_color="gray", annotation_text="平均(50)")
+    _layout(fig_all, 380, y_label)
+    figures["all"] = fig_all.to_dict()
+    return figures
+
+
+def plotly_chart(fig, **kwargs):
+    """st.plotly_chart の計測付き版（図の直列化と送信を含む）"""
+    with span("st.plotly_chart"):
+        st.plotly_chart(fig, **kwargs)
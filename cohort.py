@@ -0,0 +1,157 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from data_utils import COHORT, _round1, current_student, load_cohort_results, subscribe_results, sync_results
+from perf import traced
+
+TEST_KEY = ["lesson_type", "test_number", "subject"]
+BASE_COLUMNS = ["id", "student_id"] + TEST_KEY + ["score"]
+COHORT_COLUMNS = ["cohort_n", "cohort_mean", "cohort_std", "cohort_rank", "percentile", "cohort_deviation"]
+
+# 受けた生徒がこの人数未満の回は、パーセンタイルとクラス内偏差値を出さない
+COHORT_MIN_SIZE = 3
+
+
+def _test_hash(df: pd.DataFrame) -> np.ndarray:
+    """回ごとのハッシュ値（カテゴリーの並びが違う表どうしでも同じ回なら同じ値）"""
+    keys = df[TEST_KEY].astype({"test_number": "int64"})
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def _ranked(rows: pd.DataFrame) -> pd.DataFrame:
+    """回 (lesson_type, test_number, subject) ごとの平均・標準偏差・順位を1回の groupby で付ける。
+
+    標準偏差は母標準偏差。パーセンタイルは同点を中間の順位として「自分より下の割合」を、
+    クラス内偏差値は 50 + 10 × (得点 - 平均) / 標準偏差 を、どちらも小数1桁で返す。
+    """
+    df = rows[BASE_COLUMNS].reset_index(drop=True)
+    test = rows["test_hash"].to_numpy() if "test_hash" in rows.columns else _test_hash(df)
+    score = df["score"].to_numpy(dtype="float64")
+    g = pd.Series(score).groupby(test, sort=False)
+    n = g.transform("count").to_numpy()
+    mean = g.transform("mean").to_numpy()
+    std = g.transform("std", ddof=0).to_numpy()
+    enough = n >= COHORT_MIN_SIZE
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percentile = np.where(enough, (g.rank(method="average").to_numpy() - 0.5) / n * 100, np.nan)
+        deviation = np.where(enough & (std > 0), 50 + 10 * (score - mean) / std, np.nan)
+    return df.assign(
+        test_hash=test,
+        cohort_n=n.astype("int32"),
+        cohort_mean=_round1(mean),
+        cohort_std=_round1(std),
+        cohort_rank=g.rank(method="min", ascending=False).to_numpy().astype("int32"),
+        percentile=_round1(percentile),
+        cohort_deviation=_round1(deviation),
+    )
+
+
+class CohortRanking:
+    """クラス全体の結果から求める、回ごとの平均・標準偏差・順位。
+
+    クラス全体の結果キャッシュの変更通知で、行が増減した回だけを計算し直す。
+    rows は結果1行ごとに COHORT_COLUMNS と回のハッシュ test_hash を付けた表。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = None
+        self.version = 0
+
+    def _replace(self, untouched: pd.DataFrame, redo: pd.DataFrame):
+        self.rows = pd.concat([untouched, _ranked(redo)], ignore_index=True)
+        self.version += 1
+
+    # ─── 結果キャッシュからの通知 ───
+
+    @traced("cohort.on_reset")
+    def on_reset(self, frame: pd.DataFrame):
+        with self.lock:
+            self.rows = _ranked(frame)
+            self.version += 1
+
+    @traced("cohort.on_merge")
+    def on_merge(self, new: pd.DataFrame):
+        with self.lock:
+            if self.rows is None:
+                return
+            new = new[BASE_COLUMNS].assign(test_hash=_test_hash(new))
+            replaced = self.rows["id"].isin(new["id"]).to_numpy()
+            # 新しい行の回と、差し替え前の行の回（通常は同じ）の行だけを計算し直す
+            affected = np.concatenate([new["test_hash"].to_numpy(), self.rows["test_hash"].to_numpy()[replaced]])
+            hit = self.rows["test_hash"].isin(affected).to_numpy()
+            self._replace(self.rows[~hit], pd.concat([self.rows[hit & ~replaced], new], ignore_index=True))
+
+    @traced("cohort.on_drop")
+    def on_drop(self, ids):
+        with self.lock:
+            if self.rows is None:
+                return
+            gone = self.rows["id"].isin(ids).to_numpy()
+            if gone.any():
+                hit = self.rows["test_hash"].isin(self.rows["test_hash"].to_numpy()[gone]).to_numpy()
+                self._replace(self.rows[~hit], self.rows[hit & ~gone])
+
+    # ─── 読み出し ───
+
+    def student_metrics(self, student_id: str) -> pd.DataFrame:
+        """生徒の各結果（id）のクラス内の位置。COHORT_COLUMNS と id の表"""
+        with self.lock:
+            rows = self.rows
+        return rows.loc[rows["student_id"] == student_id, ["id"] + COHORT_COLUMNS].reset_index(drop=True)
+
+    def test_stats(self) -> pd.DataFrame:
+        """回ごとの人数・平均・標準偏差（講座・回・教科の順）"""
+        with self.lock:
+            rows = self.rows
+        stats = rows.drop_duplicates(TEST_KEY)[TEST_KEY + ["cohort_n", "cohort_mean", "cohort_std"]]
+        return stats.sort_values(TEST_KEY).reset_index(drop=True)
+
+
+@st.cache_resource
+def _cohort_ranking() -> CohortRanking:
+    ranking = CohortRanking()
+    subscribe_results(ranking, COHORT)
+    return ranking
+
+
+def get_cohort_ranking() -> CohortRanking:
+    """クラス全体の結果を同期したうえで、回ごとの順位表を返す"""
+    ranking = _cohort_ranking()
+    # 同期で差分が届けば on_merge で更新される
+    sync_results(COHORT)
+    return ranking
+
+
+def _tests_metrics(df: pd.DataFrame, student_id: str) -> pd.DataFrame:
+    """df の回だけをクラス全体から読み込んで順位を求め、生徒の各結果の COHORT_COLUMNS と id を返す"""
+    if df.empty:
+        return pd.DataFrame(columns=["id"] + COHORT_COLUMNS)
+    # 講座・回・教科それぞれの in 条件で絞るので、df に無い回が混ざることもある（順位は回ごとなので影響しない）
+    rows = load_cohort_results(
+        lesson_type=df["lesson_type"].astype(str).unique().tolist(),
+        test_number=df["test_number"].astype(int).unique().tolist(),
+        subject=df["subject"].astype(str).unique().tolist(),
+        columns=BASE_COLUMNS, include_pending=False,
+    )
+    ranked = _ranked(rows)
+    return ranked.loc[ranked["student_id"] == student_id, ["id"] + COHORT_COLUMNS]
+
+
+def with_cohort_metrics(df: pd.DataFrame, student_id: str = None,
+                        ranking: CohortRanking = None) -> pd.DataFrame:
+    """生徒（省略時はこのセッションの生徒）の結果 df に id で COHORT_COLUMNS を付ける。
+
+    ranking を渡さなければ、df の回 (lesson_type, test_number, subject) の結果だけを読み込んで求める。
+    全生徒の結果は同期しないので、苦手候補の回など少しの回だけを見るときはこちらを使う。
+    送信待ちの行（id が負）などクラスの表に無い行は欠損になる。
+    """
+    student_id = student_id or current_student()
+    if ranking is None:
+        metrics = _tests_metrics(df, student_id)
+    else:
+        metrics = ranking.student_metrics(student_id)
+    return df.merge(metrics, on="id", how="left")
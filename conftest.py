@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# テスト中に単元マスタの裏取得などが Supabase を見に行かないようにする
+os.environ.setdefault("JUKU_STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("JUKU_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "juku_test.sqlite3"))
+os.environ.setdefault("JUKU_WRITE_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "juku_test_pending.jsonl"))
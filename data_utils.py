@@ -1,59 +1,686 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Iterator
+
+import numpy as np
 import pandas as pd
 import streamlit as st
-from supabase import create_client, Client
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from perf import register_counters, span, traced
+from settings import get_setting
+from storage import BASE_DIR, DEFAULT_STUDENT_ID, STUDENT_FIELDS, UNITS_CSV, get_storage
+
+logger = logging.getLogger(__name__)
 
 SUBJECTS = ["国語", "算数", "理科", "社会"]
 LESSON_TYPES = ["通常", "春期", "夏期", "冬期"]
 
+# 読み込み時に当てる列の型。リストはその値をカテゴリーにした category 型。
+# 得点類は入力が 0.1 刻み・500 点以下なので float32 で足りる（計算時に float64 へ戻す）。
+RESULT_SCHEMA = {
+    "id": "int64",
+    "lesson_type": LESSON_TYPES,
+    "test_number": "int16",
+    "subject": SUBJECTS,
+    "score": "float32",
+    "average_score": "float32",
+    "max_score": "float32",
+    "std_dev": "float32",
+}
+UNIT_SCHEMA = {
+    "subject": SUBJECTS,
+    "lesson_type": LESSON_TYPES,
+    "test_number": "int16",
+}
+
+
+def _apply_schema(df: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        if isinstance(dtype, list):
+            # 想定外の値は落とさず、カテゴリーの末尾に足す
+            extra = sorted(set(df[col].dropna().astype(str)) - set(dtype))
+            df[col] = pd.Categorical(df[col], categories=dtype + extra)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+# ─── 同時リクエストのまとめ ──────────────────────
+
+# 同じ問い合わせの結果を使い回す時間（秒）。0 なら実行中のものへの相乗りだけ
+REQUEST_FRESH_SEC = float(get_setting("REQUEST_FRESH_SEC", 2))
+
+
+class _SingleFlight:
+    """同じキーの同時呼び出しを1回の実行にまとめる（single-flight）。
+
+    実行中のキーを呼んだスレッドはその結果を待って受け取り（coalesced）、
+    終わってから fresh_sec 以内なら前回の結果をそのまま返す（hit）。
+    キーの先頭要素を種類として、種類ごとに hits / coalesced / misses を数える。
+    結果は呼び出し元どうしで共有されるので、変更しないこと。
+    """
+
+    def __init__(self, fresh_sec: float):
+        self.fresh_sec = fresh_sec
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.recent = {}
+        self.stats = {}
+
+    def _count(self, kind, name):
+        counts = self.stats.setdefault(kind, {"hits": 0, "coalesced": 0, "misses": 0})
+        counts[name] += 1
+
+    def do(self, key: tuple, fn):
+        now = time.monotonic()
+        with self.lock:
+            done = self.recent.get(key)
+            if done is not None and now - done[0] <= self.fresh_sec:
+                self._count(key[0], "hits")
+                return done[1]
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+                self._count(key[0], "misses")
+                # 期限切れの結果を捨てる
+                self.recent = {k: v for k, v in self.recent.items() if now - v[0] <= self.fresh_sec}
+            else:
+                self._count(key[0], "coalesced")
+        if not leader:
+            return future.result()
+        try:
+            value = fn()
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.inflight[key]
+            self.recent[key] = (time.monotonic(), value)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, kind: str):
+        """書き込みの後などに、その種類の使い回しをやめる（実行中のものはそのまま）"""
+        with self.lock:
+            self.recent = {k: v for k, v in self.recent.items() if k[0] != kind}
+
 
 @st.cache_resource
-def get_supabase() -> Client:
-    url = st.secrets["SUPABASE_URL"]
-    key = st.secrets["SUPABASE_KEY"]
-    return create_client(url, key)
+def _request_flight() -> _SingleFlight:
+    flight = _SingleFlight(REQUEST_FRESH_SEC)
+    register_counters("保存先への問い合わせ（プロセス累計）", request_stats)
+    return flight
+
+
+def request_stats() -> dict:
+    """種類ごとの hits（使い回し）/ coalesced（実行中への相乗り）/ misses（実際の問い合わせ）"""
+    flight = _request_flight()
+    with flight.lock:
+        return {kind: dict(counts) for kind, counts in flight.stats.items()}
+
+
+def _freeze(value):
+    # 問い合わせの条件を single-flight のキーにできる形にする
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value if value is None or np.isscalar(value) else str(value)
 
 
 # ─── 単元 ──────────────────────────────────────────
 
-@st.cache_data(ttl=3600)
+UNIT_COLUMNS = ["subject", "lesson_type", "test_number", "unit_name", "content"]
+
+# 保存先の単元マスタを見に行く間隔（秒）
+UNITS_REFRESH_SEC = int(get_setting("UNITS_REFRESH_SEC", 3600))
+
+# 保存先から取得した最新の単元マスタの控え。次回起動時は同梱の CSV より優先する
+UNITS_SNAPSHOT = os.path.join(BASE_DIR, "data", "units_snapshot.pkl")
+
+
+def _normalize_units(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.reindex(columns=UNIT_COLUMNS)
+    df = df.astype({"subject": str, "lesson_type": str, "test_number": "int64"})
+    df[["unit_name", "content"]] = df[["unit_name", "content"]].fillna("").astype(str)
+    df = df.sort_values(["subject", "lesson_type", "test_number", "unit_name"]).reset_index(drop=True)
+    return _apply_schema(df, UNIT_SCHEMA)
+
+
+def _units_hash(df: pd.DataFrame) -> str:
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()
+
+
+def _read_units_start() -> pd.DataFrame:
+    """起動時の単元マスタ。控えが読めなければ（途中で切れた・pandas の更新で読めないなど）CSV を使う"""
+    if os.path.exists(UNITS_SNAPSHOT):
+        try:
+            return _normalize_units(pd.read_pickle(UNITS_SNAPSHOT))
+        except Exception:
+            logger.warning("単元マスタの控えを読めませんでした（捨てて同梱の CSV を使います）", exc_info=True)
+            # 次に保存先の内容が変わったときに書き直される
+            try:
+                os.remove(UNITS_SNAPSHOT)
+            except OSError:
+                pass
+    return _normalize_units(pd.read_csv(UNITS_CSV, dtype={"unit_name": str, "content": str}))
+
+
+def _write_units_snapshot(frame: pd.DataFrame):
+    # 書き込み途中で止まっても控えが壊れないよう、一時ファイルに書いてから置き換える
+    tmp = UNITS_SNAPSHOT + ".tmp"
+    frame.to_pickle(tmp)
+    os.replace(tmp, UNITS_SNAPSHOT)
+
+
+class _UnitIndex:
+    """単元マスタの引き当て用インデックス"""
+
+    def __init__(self, units_df: pd.DataFrame):
+        self.empty_frame = units_df.iloc[0:0]
+        self.by_key = {
+            (str(subject), str(lesson_type), int(test_number)): group
+            for (subject, lesson_type, test_number), group
+            in units_df.groupby(["subject", "lesson_type", "test_number"], sort=False, observed=True)
+        }
+        self.numbers = {
+            str(lesson_type): sorted(int(n) for n in numbers.unique())
+            for lesson_type, numbers in units_df.groupby("lesson_type", observed=True)["test_number"]
+        }
+
+
+class _UnitsStore:
+    """単元マスタの保持と stale-while-revalidate による更新。
+
+    起動時は控え（無ければ同梱の data/units.csv）をすぐ返し、保存先からの取得は
+    バックグラウンドで行う。内容のハッシュが変わったときだけ差し替えるので、
+    単元マスタから作るインデックスや集計もハッシュ（version）をキーにすればよい。
+    引き当て用のインデックス（index）は差し替えと同時に作り直して持っておく。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = _read_units_start()
+        self.version = _units_hash(self.frame)
+        with span("load_unit_index"):
+            self.index = _UnitIndex(self.frame)
+        self.checked_at = None
+        self.refreshing = False
+
+    def _refresh_if_stale(self):
+        """古ければ裏で取り直しを始める（呼ぶときは lock を持つこと）"""
+        stale = self.checked_at is None or time.monotonic() - self.checked_at > UNITS_REFRESH_SEC
+        if stale and not self.refreshing:
+            self.refreshing = True
+            worker = threading.Thread(target=self.refresh, name="units-refresh", daemon=True)
+            # 取り直しで st.cache_resource を呼ぶので、呼び出したセッションの文脈を引き継ぐ
+            ctx = get_script_run_ctx()
+            if ctx is not None:
+                add_script_run_ctx(worker, ctx)
+            worker.start()
+
+    def current(self):
+        """(単元マスタ, version) を返す。古ければ裏で取り直しを始める"""
+        with self.lock:
+            self._refresh_if_stale()
+            return self.frame, self.version
+
+    def current_index(self) -> _UnitIndex:
+        """引き当て用のインデックスを返す。古ければ裏で取り直しを始める"""
+        with self.lock:
+            self._refresh_if_stale()
+            return self.index
+
+    def refresh(self):
+        try:
+            with span("units.refresh") as s:
+                rows = s.measure(_request_flight().do(("units",), get_storage().fetch_units))
+            if not rows:
+                return
+            frame = _normalize_units(pd.DataFrame(rows))
+            version = _units_hash(frame)
+            if version != self.version:
+                with span("load_unit_index"):
+                    index = _UnitIndex(frame)
+                with self.lock:
+                    self.frame, self.version, self.index = frame, version, index
+                try:
+                    _write_units_snapshot(frame)
+                except OSError:
+                    logger.warning("単元マスタの控えを保存できませんでした", exc_info=True)
+        except Exception:
+            logger.warning("単元マスタの更新に失敗しました（手元のデータを使い続けます）", exc_info=True)
+        finally:
+            with self.lock:
+                self.checked_at = time.monotonic()
+                self.refreshing = False
+
+
+@st.cache_resource
+def _units_store() -> _UnitsStore:
+    return _UnitsStore()
+
+
+def current_units() -> tuple:
+    """(単元マスタ, 内容ハッシュ) の組。単元マスタはプロセス共通のため変更しないこと"""
+    return _units_store().current()
+
+
 def load_units() -> pd.DataFrame:
-    sb = get_supabase()
-    res = sb.table("units").select("*").execute()
-    if res.data:
-        return pd.DataFrame(res.data)
-    return pd.DataFrame(columns=["subject", "lesson_type", "test_number", "unit_name", "content"])
+    return current_units()[0]
+
+
+def units_version() -> str:
+    return current_units()[1]
+
+
+def load_unit_index() -> _UnitIndex:
+    """単元マスタの引き当て用インデックス（単元マスタの内容が変わったときだけ作り直される）"""
+    return _units_store().current_index()
 
 
 def get_units_for_test(subject: str, lesson_type: str, test_number: int) -> pd.DataFrame:
-    units_df = load_units()
-    if units_df.empty:
+    index = load_unit_index()
+    if not index.by_key:
         return pd.DataFrame()
-    return units_df[
-        (units_df["subject"] == subject) &
-        (units_df["lesson_type"] == lesson_type) &
-        (units_df["test_number"] == int(test_number))
-    ]
+    return index.by_key.get((subject, lesson_type, int(test_number)), index.empty_frame)
+
+
+def get_test_numbers(lesson_type: str) -> list:
+    """講座種別ごとの講義No.（昇順）"""
+    return load_unit_index().numbers.get(lesson_type, [])
+
+
+# ─── 生徒 ──────────────────────────────────────────
+
+def current_student() -> str:
+    """このセッションで選んでいる生徒（サイドバーの選択 → URL の ?student= → 既定の生徒）"""
+    if get_script_run_ctx() is None:
+        return DEFAULT_STUDENT_ID
+    return st.session_state.get("student_id") or st.query_params.get("student") or DEFAULT_STUDENT_ID
+
+
+@st.cache_data(ttl=300)
+def list_students() -> pd.DataFrame:
+    """登録されている生徒（student_id, name）"""
+    df = pd.DataFrame(get_storage().fetch_students(), columns=STUDENT_FIELDS)
+    if df.empty:
+        df = pd.DataFrame([{"student_id": DEFAULT_STUDENT_ID, "name": DEFAULT_STUDENT_ID}])
+    return df
+
+
+def add_students(records: list):
+    """生徒を登録する（同じ student_id なら名前を上書き）。records は student_id / name の dict"""
+    get_storage().upsert_students(records)
+    list_students.clear()
+
+
+def render_student_selector() -> str:
+    """サイドバーで生徒を選ばせ、選んだ student_id を返す（URL の ?student= にも残す）"""
+    students = list_students()
+    names = dict(zip(students["student_id"], students["name"].fillna(students["student_id"])))
+    current = current_student()
+    options = list(names) if current in names else list(names) + [current]
+    student_id = st.sidebar.selectbox("👤 生徒", options, index=options.index(current),
+                                      format_func=lambda s: names.get(s, s))
+    st.session_state["student_id"] = student_id
+    if st.query_params.get("student") != student_id:
+        st.query_params["student"] = student_id
+    return student_id
 
 
 # ─── テスト結果 ────────────────────────────────────
 
-def load_results() -> pd.DataFrame:
-    sb = get_supabase()
-    res = sb.table("test_results").select("*").order("test_date").execute()
-    if res.data:
-        df = pd.DataFrame(res.data)
+RESULT_COLUMNS = [
+    "id", "student_id", "test_date", "lesson_type", "test_number", "subject",
+    "score", "average_score", "max_score", "std_dev", "memo"
+]
+
+# 他セッションでの削除は差分同期では検知できないので、この間隔で全件を取り直す
+RESULT_FULL_RESYNC_SEC = 600
+
+# ページング取得の既定値（1ページの行数と同時に取得するページ数）
+RESULT_PAGE_SIZE = 1000
+RESULT_FETCH_WORKERS = 4
+
+
+def _results_frame(rows, columns=None) -> pd.DataFrame:
+    if not rows:
+        return _apply_schema(pd.DataFrame(columns=columns or RESULT_COLUMNS), RESULT_SCHEMA)
+    df = pd.DataFrame(rows)
+    if "test_date" in df.columns:
         df["test_date"] = pd.to_datetime(df["test_date"])
-        return df
-    return pd.DataFrame(columns=[
-        "id", "test_date", "lesson_type", "test_number", "subject",
-        "score", "average_score", "max_score", "std_dev", "memo"
-    ])
+    return _apply_schema(df, RESULT_SCHEMA)
 
 
-def add_result(test_date, lesson_type, test_number, subject,
-               score, average_score, max_score, std_dev=None, memo=""):
-    sb = get_supabase()
-    sb.table("test_results").insert({
+def _walk_ids(storage, after_id, page_size, upper_id=None, **filters) -> Iterator[list]:
+    """id をキーにしたキーセットページング。1ページ未満が返ったら終わり"""
+    while True:
+        rows = storage.fetch_results(after_id, page_size, upper_id=upper_id, **filters)
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        after_id = rows[-1]["id"]
+
+
+def iter_results(page_size: int = None, max_workers: int = None,
+                 since_id: int = 0, updated_since=None, student_id=None) -> Iterator[pd.DataFrame]:
+    """test_results をページ単位の DataFrame で順次返す（id 順とは限らない）。
+
+    page_size はサーバー側の最大行数（PostgREST の max-rows）以下にすること。
+    updated_since を渡すと「since_id より新しい行、または updated_since 以降に
+    更新された行」だけを取得する。student_id（1つの値かリスト）を渡すとその生徒の行だけを
+    先頭から順にたどる（max_workers で並列にするのはクラス全体の読み込みだけ）。
+    """
+    storage = get_storage()
+    page_size = int(page_size or RESULT_PAGE_SIZE)
+    max_workers = int(max_workers or RESULT_FETCH_WORKERS)
+
+    if updated_since is not None or since_id or student_id is not None:
+        # 差分同期や1人分の読み込みは件数が少ないので先頭から順にたどる
+        # （id の範囲で区切ると、全生徒の id の幅だけ問い合わせが増える）
+        start = 0 if updated_since is not None else since_id
+        for rows in _walk_ids(storage, start, page_size, since_id=since_id, updated_since=updated_since,
+                              student_id=student_id):
+            yield _results_frame(rows)
+        return
+
+    max_id = storage.max_result_id()
+    if max_id is None:
+        return
+
+    if max_workers <= 1:
+        for rows in _walk_ids(storage, 0, page_size, upper_id=max_id):
+            yield _results_frame(rows)
+    else:
+        # id の範囲を page_size 幅に区切り、各範囲を別スレッドでたどる。
+        # 実行中の範囲数を max_workers * 2 までに抑えてメモリを一定に保つ。
+        ranges = iter([(lo, min(lo + page_size, max_id)) for lo in range(0, max_id, page_size)])
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            def submit_next():
+                r = next(ranges, None)
+                if r is not None:
+                    # 計測の再実行 id を引き継ぐため、呼び出し元のコンテキストで動かす
+                    pending.add(pool.submit(
+                        contextvars.copy_context().run,
+                        lambda lo, hi: list(_walk_ids(storage, lo, page_size, upper_id=hi)), *r,
+                    ))
+
+            pending = set()
+            for _ in range(max_workers * 2):
+                submit_next()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    for rows in f.result():
+                        yield _results_frame(rows)
+                    submit_next()
+
+    # 最大 id を調べた後に追加された行
+    for rows in _walk_ids(storage, max_id, page_size):
+        yield _results_frame(rows)
+
+
+def _concat_chunks(chunks) -> pd.DataFrame:
+    frames = [c for c in chunks if not c.empty]
+    if not frames:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    return df.sort_values(["test_date", "id"]).reset_index(drop=True)
+
+
+class _ResultCache:
+    """1人の生徒（student_id が COHORT ならクラス全体）の test_results のプロセス共有キャッシュ。
+
+    前回同期時の id / updated_at を透かし(watermark)として持ち、
+    再実行のたびにそれより新しい行だけを取り寄せてマージする。
+    内容が変わるたびに購読者の on_reset / on_merge / on_drop を呼ぶ。
+    """
+
+    def __init__(self, student_id=None):
+        self.student_id = student_id
+        self.lock = threading.RLock()
+        self.frame = None
+        self.max_id = 0
+        self.max_updated = None
+        self.synced_at = 0.0
+        self.version = 0
+        self.listeners = []
+
+    def subscribe(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+            if self.frame is not None:
+                listener.on_reset(self.frame)
+
+    def sync(self, copy: bool = True) -> pd.DataFrame:
+        """保存先と同期して全件を返す。
+
+        同じ生徒の同期が同時に来たら1回にまとめ、直後（REQUEST_FRESH_SEC 以内）の
+        同期は問い合わせを省く。
+        """
+        with span("results.sync") as s:
+            _request_flight().do(("results.sync", self.student_id), self._refresh)
+            with self.lock:
+                return s.measure(self.frame.copy() if copy else self.frame)
+
+    def _refresh(self):
+        with self.lock:
+            if self.frame is None or time.monotonic() - self.synced_at > RESULT_FULL_RESYNC_SEC:
+                self.frame = _concat_chunks(iter_results(student_id=self.student_id))
+                self.version += 1
+                self.synced_at = time.monotonic()
+                self._advance(self.frame)
+                for listener in self.listeners:
+                    listener.on_reset(self.frame)
+            else:
+                new = _concat_chunks(iter_results(since_id=self.max_id, updated_since=self.max_updated,
+                                                  student_id=self.student_id))
+                if not new.empty:
+                    self.merge(new)
+                    self._advance(new)
+
+    def _advance(self, new: pd.DataFrame):
+        if new.empty:
+            return
+        self.max_id = max(self.max_id, int(new["id"].max()))
+        if "updated_at" in new.columns:
+            latest = pd.to_datetime(new["updated_at"], utc=True).idxmax()
+            candidate = new.loc[latest, "updated_at"]
+            if self.max_updated is None or pd.Timestamp(candidate) > pd.Timestamp(self.max_updated):
+                self.max_updated = candidate
+
+    def merge(self, new: pd.DataFrame):
+        """同じ id の行を差し替えて test_date 順に並べ直す"""
+        with self.lock:
+            if self.frame is None or new.empty:
+                return
+            kept = self.frame[~self.frame["id"].isin(new["id"])]
+            merged = pd.concat([kept, new], ignore_index=True) if not kept.empty else new
+            self.frame = merged.sort_values(["test_date", "id"]).reset_index(drop=True)
+            self.version += 1
+            for listener in self.listeners:
+                listener.on_merge(new)
+
+    def drop(self, ids):
+        with self.lock:
+            if self.frame is None:
+                return
+            self.frame = self.frame[~self.frame["id"].isin(ids)].reset_index(drop=True)
+            self.version += 1
+            for listener in self.listeners:
+                listener.on_drop(ids)
+
+
+# _result_cache などでクラス全体（全生徒）を表すキー
+COHORT = None
+_result_caches_lock = threading.Lock()
+
+
+@st.cache_resource
+def _result_caches() -> dict:
+    """student_id（COHORT はクラス全体）→ _ResultCache。各セッションは自分の生徒の分だけ同期する"""
+    return {}
+
+
+def _result_cache(student_id=COHORT) -> _ResultCache:
+    caches = _result_caches()
+    with _result_caches_lock:
+        if student_id not in caches:
+            caches[student_id] = _ResultCache(student_id)
+        return caches[student_id]
+
+
+def subscribe_results(listener, student_id):
+    """生徒 student_id（COHORT ならクラス全体）の test_results キャッシュの変更通知を受け取る。
+
+    listener は on_reset(frame) / on_merge(new_rows) / on_drop(ids) を持つこと。
+    on_merge の new_rows には既存行の差し替え分も含まれる（同じ id）。
+    """
+    _result_cache(student_id).subscribe(listener)
+
+
+def sync_results(student_id) -> int:
+    """生徒（COHORT ならクラス全体）のキャッシュを差分同期し、版番号を返す。
+
+    購読者（集計）を最新にしたいだけで、結果の表そのものは要らないとき用。
+    """
+    cache = _result_cache(student_id)
+    cache.sync(copy=False)
+    return cache.version
+
+
+def _apply_written(rows):
+    # 書き込んだ行はキャッシュに即反映するが、watermark は進めない。
+    # 進めると、他プロセスがその間に追加した行を取りこぼすため。
+    if not rows:
+        return
+    # 書き込んだ行が次の読み込みに必ず入るよう、絞り込み結果の使い回しをやめる
+    _request_flight().invalidate("results.query")
+    frame = _results_frame(rows)
+    caches = _result_caches()
+    for student_id, part in frame.groupby("student_id", sort=False):
+        if student_id in caches:
+            caches[student_id].merge(part.reset_index(drop=True))
+    if COHORT in caches:
+        caches[COHORT].merge(frame)
+
+
+def _as_list(value):
+    return [value] if np.isscalar(value) else list(value)
+
+
+def _filter_results(df, subject=None, lesson_type=None, date_from=None, date_to=None,
+                    columns=None, order=None, limit=None, student_id=None, test_number=None) -> pd.DataFrame:
+    mask = np.ones(len(df), dtype=bool)
+    if student_id is not None:
+        mask &= df["student_id"].isin(_as_list(student_id)).to_numpy()
+    if subject is not None:
+        mask &= df["subject"].isin(_as_list(subject)).to_numpy()
+    if lesson_type is not None:
+        mask &= df["lesson_type"].isin(_as_list(lesson_type)).to_numpy()
+    if test_number is not None:
+        mask &= df["test_number"].isin([int(n) for n in _as_list(test_number)]).to_numpy()
+    if date_from is not None:
+        mask &= (df["test_date"] >= pd.Timestamp(date_from)).to_numpy()
+    if date_to is not None:
+        mask &= (df["test_date"] <= pd.Timestamp(date_to)).to_numpy()
+    df = df[mask]
+    if order:
+        # サーバー側と同じく、カテゴリー列も文字列として並べる
+        tie = ["id"] if "id" in df.columns else []
+        df = df.sort_values([c.lstrip("-") for c in order] + tie,
+                            ascending=[not c.startswith("-") for c in order] + [True] * len(tie),
+                            key=lambda col: col.astype(str) if isinstance(col.dtype, pd.CategoricalDtype) else col)
+    if limit is not None:
+        df = df.head(limit)
+    if columns:
+        df = df[list(columns)]
+    return df.reset_index(drop=True)
+
+
+def load_results(subject=None, lesson_type=None, date_from=None, date_to=None,
+                 columns=None, order=None, limit=None, include_pending: bool = True,
+                 student_id: str = None, test_number=None) -> pd.DataFrame:
+    """生徒 student_id（省略時はこのセッションの生徒）のテスト結果を読み込む（既定は全件を test_date 順で）。
+
+    subject / lesson_type / test_number は1つの値またはリスト、order は列名のリスト
+    （先頭に "-" で降順）。条件を指定した場合、このプロセスにまだその生徒の全件の
+    キャッシュが無ければ条件をサーバー側のクエリに変換し、必要な行と列
+    だけを取得する。全件キャッシュがあれば差分同期してから手元で絞り込む。
+    include_pending=True なら書き込みキューで送信待ちの行も反映する
+    （未保存の新規行の id は負の値）。
+    """
+    student_id = student_id or current_student()
+    filters = dict(subject=subject, lesson_type=lesson_type, test_number=test_number,
+                   date_from=date_from, date_to=date_to, columns=columns, order=order, limit=limit)
+    return _load_results(_result_cache(student_id), student_id, filters, include_pending)
+
+
+def load_cohort_results(student_ids=None, subject=None, lesson_type=None, test_number=None,
+                        date_from=None, date_to=None, columns=None, order=None, limit=None,
+                        include_pending: bool = True) -> pd.DataFrame:
+    """クラス全体（student_ids を渡せばその生徒たち）のテスト結果を読み込む。
+
+    条件の意味は load_results と同じ。全生徒分のキャッシュは条件なしで呼んだときだけ作るので、
+    1回分の比較など絞り込んだ読み込みは、キャッシュが無ければサーバー側のクエリで済ませる。
+    """
+    filters = dict(subject=subject, lesson_type=lesson_type, test_number=test_number,
+                   date_from=date_from, date_to=date_to, columns=columns, order=order, limit=limit)
+    return _load_results(_result_cache(COHORT), student_ids, filters, include_pending)
+
+
+def _load_results(cache: _ResultCache, student_id, filters: dict, include_pending: bool) -> pd.DataFrame:
+    columns = filters["columns"]
+    if any(v is not None and not _as_list(v)
+           for v in (student_id, filters["subject"], filters["lesson_type"], filters["test_number"])):
+        return _results_frame([], columns)
+    pending = _write_queue().records() if include_pending and _queue_in_use() else []
+    if student_id is not None:
+        pending = [r for r in pending if r["student_id"] in _as_list(student_id)]
+    if pending:
+        # 送信待ちの行と突き合わせるため、キー列も含めて読み込み、最後に絞る
+        filters["columns"] = None
+    # 生徒ごとのキャッシュは生徒で絞る必要がない
+    local = dict(filters, student_id=student_id if cache.student_id is COHORT else None)
+    if all(v is None for v in local.values()):
+        df = cache.sync()
+    elif cache.frame is not None:
+        df = _filter_results(cache.sync(copy=False), **local)
+    else:
+        query = dict(filters, student_id=student_id, order=filters["order"] or ["test_date"])
+        with span("results.query") as s:
+            rows = _request_flight().do(("results.query", _freeze(query)),
+                                        lambda: get_storage().query_results(**query))
+            df = s.measure(_results_frame(rows, filters["columns"]))
+    if pending:
+        df = _overlay_pending(df, pending, dict(local, columns=columns))
+    return df
+
+
+# upsert の重複判定キー（テーブル側に同じ列の一意制約が必要）
+RESULT_KEY = ["student_id", "lesson_type", "test_number", "subject"]
+
+
+def _result_record(test_date, lesson_type, test_number, subject,
+                   score, average_score, max_score, std_dev=None, memo="", student_id=None) -> dict:
+    return {
+        "student_id": student_id or current_student(),
         "test_date": str(test_date),
         "lesson_type": lesson_type,
         "test_number": int(test_number),
@@ -61,75 +688,488 @@ def add_result(test_date, lesson_type, test_number, subject,
         "score": float(score),
         "average_score": float(average_score),
         "max_score": float(max_score),
-        "std_dev": float(std_dev) if std_dev else None,
-        "memo": memo,
-    }).execute()
+        "std_dev": float(std_dev) if std_dev and not pd.isna(std_dev) else None,
+        "memo": memo if isinstance(memo, str) else "",
+    }
+
+
+def results_version(df: pd.DataFrame = None, student_id: str = None):
+    """結果データの版（キャッシュキー用）。
+
+    生徒（省略時はこのセッションの生徒）の全件キャッシュがあればその版番号、
+    無ければ df の内容から求めたハッシュ値。load_results は送信待ちの行も重ねて返すので、
+    キューを使っているときは送信待ちの版も含める（受け付けたときと送り終えたときに変わる）。
+    """
+    student_id = student_id or current_student()
+    cache = _result_cache(student_id)
+    pending = _write_queue().version if _queue_in_use() else None
+    if cache.frame is not None or df is None:
+        return ("cache", student_id, cache.version, pending)
+    return ("hash", int(pd.util.hash_pandas_object(df, index=False).sum()))
+
+
+def add_result(test_date, lesson_type, test_number, subject,
+               score, average_score, max_score, std_dev=None, memo="", student_id=None):
+    written = get_storage().insert_results([_result_record(
+        test_date, lesson_type, test_number, subject,
+        score, average_score, max_score, std_dev, memo, student_id,
+    )])
+    _apply_written(written)
+
+
+def upsert_results(rows: list, with_status: bool = True) -> list:
+    """複数行をまとめて1回の upsert で書き込む。
+
+    rows は upsert_result と同じ引数名の dict のリスト（student_id を省くとこのセッションの生徒）。
+    戻り値は各行の "saved"（新規）/ "updated"（上書き）を rows と同じ順で返す。
+    新規か上書きかは生徒の全件キャッシュの id で判定するため、キャッシュがまだ無い生徒は
+    書き込みの前にその生徒の分を読み込む（その回は1往復では済まない）。
+    with_status=False なら判定をせず空のリストを返す（一括取り込み向け）。
+    """
+    if not rows:
+        return []
+    records = {}
+    for row in rows:
+        rec = _result_record(**row)
+        # 同じキーが複数あると upsert が失敗するので後勝ちにする
+        records[tuple(rec[k] for k in RESULT_KEY)] = rec
+
+    if not with_status:
+        _apply_written(get_storage().upsert_results(list(records.values()), RESULT_KEY))
+        return []
+
+    known_ids = set()
+    for student_id in {rec["student_id"] for rec in records.values()}:
+        cache = _result_cache(student_id)
+        if cache.frame is None:
+            cache.sync(copy=False)
+        with cache.lock:
+            known_ids.update(cache.frame["id"].tolist())
+
+    written = get_storage().upsert_results(list(records.values()), RESULT_KEY)
+    _apply_written(written)
+
+    # 返ってきた id が手元に既にあれば上書き、無ければ新規
+    status = {
+        tuple(r[k] for k in RESULT_KEY): ("updated" if r["id"] in known_ids else "saved")
+        for r in written
+    }
+    return [status.get(tuple(_result_record(**row)[k] for k in RESULT_KEY), "saved") for row in rows]
 
 
 def upsert_result(test_date, lesson_type, test_number, subject,
-                  score, average_score, max_score, std_dev=None, memo=""):
+                  score, average_score, max_score, std_dev=None, memo="", student_id=None):
     """既存データがあれば上書き、なければ新規追加"""
-    sb = get_supabase()
-    res = sb.table("test_results").select("id") \
-        .eq("lesson_type", lesson_type) \
-        .eq("test_number", int(test_number)) \
-        .eq("subject", subject) \
-        .execute()
-    data = {
-        "test_date": str(test_date),
-        "lesson_type": lesson_type,
-        "test_number": int(test_number),
-        "subject": subject,
-        "score": float(score),
-        "average_score": float(average_score),
-        "max_score": float(max_score),
-        "std_dev": float(std_dev) if std_dev else None,
-        "memo": memo,
-    }
-    if res.data:
-        existing_id = res.data[0]["id"]
-        sb.table("test_results").update(data).eq("id", existing_id).execute()
-        return "updated"
-    else:
-        sb.table("test_results").insert(data).execute()
-        return "saved"
+    return upsert_results([dict(
+        test_date=test_date, lesson_type=lesson_type, test_number=test_number,
+        subject=subject, score=score, average_score=average_score,
+        max_score=max_score, std_dev=std_dev, memo=memo, student_id=student_id,
+    )])[0]
+
+
+def delete_result(result_id: int, student_id: str = None):
+    get_storage().delete_results([result_id])
+    _request_flight().invalidate("results.query")
+    caches = _result_caches()
+    for key in (student_id or current_student(), COHORT):
+        if key in caches:
+            caches[key].drop([result_id])
+
+
+# ─── 書き込みキュー ────────────────────────────────
+
+# 入力ページの保存をキュー経由にするか（"1" / "true" で有効）。
+# 送信待ちの控えはこのプロセスのディスクにしか無く、Streamlit Cloud のように再起動でディスクが
+# 消える環境では「受け付けました」の後に失われうる。また他のプロセスからは送信が済むまで見えない。
+# そのため既定はその場で書き込み（1回の upsert）とし、ディスクが残る1台構成でだけ有効にする
+WRITE_BEHIND = str(get_setting("WRITE_BEHIND", "0")).lower() in ("1", "true", "yes")
+# 送信待ちの保存を書いておくファイル（再起動しても失われないように）
+WRITE_QUEUE_PATH = get_setting("WRITE_QUEUE_PATH", os.path.join(BASE_DIR, "data", "pending_writes.jsonl"))
+# 再送しても通らない行を取り置くファイル
+WRITE_FAILED_PATH = get_setting("WRITE_FAILED_PATH", os.path.join(BASE_DIR, "data", "failed_writes.jsonl"))
+# 連続した保存を1回の upsert にまとめるための待ち時間（秒）と1回の最大行数
+WRITE_FLUSH_DELAY_SEC = 0.2
+WRITE_BATCH_SIZE = 200
+# 失敗時の再送間隔（秒）。失敗が続くたびに倍にし、上限で止める
+WRITE_RETRY_BASE_SEC = 1.0
+WRITE_RETRY_MAX_SEC = 60.0
+# 原因の分からない失敗は、この回数続いたら再送をやめて取り置く
+WRITE_MAX_ATTEMPTS = 8
+
+# Postgres の SQLSTATE のうち、時間を置けば通りうるもの（接続・トランザクションの競合・資源不足・停止中）
+_TRANSIENT_SQLSTATE = ("08", "40", "53", "57")
+
+
+def _write_error_kind(exc: Exception) -> str:
+    """書き込みの失敗を "transient"（時間を置けば通る）/ "permanent"（何度送っても通らない）/ "unknown" に分ける"""
+    if isinstance(exc, (OSError, TimeoutError)):
+        return "transient"
+    if isinstance(exc, sqlite3.OperationalError):
+        message = str(exc).lower()
+        return "transient" if any(w in message for w in ("locked", "busy", "unable to open", "disk i/o")) else "permanent"
+    if isinstance(exc, (sqlite3.DatabaseError, ValueError, TypeError, KeyError)):
+        return "permanent"
+    # Supabase（postgrest）の APIError は code に SQLSTATE を持つ
+    code = getattr(exc, "code", None)
+    if type(exc).__name__ == "APIError" and isinstance(code, str):
+        return "transient" if code[:2] in _TRANSIENT_SQLSTATE else "permanent"
+    # httpx の通信エラー（接続できない・タイムアウトなど）
+    if type(exc).__module__.split(".")[0] == "httpx":
+        return "transient"
+    return "unknown"
+
 
+class _WriteBehindQueue:
+    """保存をすぐに受け付け、裏のスレッドでまとめて書き込むキュー。
 
-def delete_result(result_id: int):
-    sb = get_supabase()
-    sb.table("test_results").delete().eq("id", result_id).execute()
+    送信待ちの行はキー (student_id, lesson_type, test_number, subject) ごとに最新の1件だけ持ち、
+    変更のたびに WRITE_QUEUE_PATH へ書き出す。起動時にそのファイルがあれば読み込んで
+    送信を再開する。通信断などは間隔を空けて再送し、内容の誤りなど再送しても通らない行は
+    1行ずつ送り直して切り分け、通らなかった行だけを WRITE_FAILED_PATH に取り置く。
+    """
+
+    def __init__(self, path: str, failed_path: str):
+        self.path = path
+        self.failed_path = failed_path
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.failures = 0
+        self.failed = 0
+        self.last_error = None
+        self.last_flush = None
+        self.retry_at = None
+        self.worker = None
+        # 送信待ちの中身が変わるたびに増える（結果の版に含める）
+        self.version = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        rec = json.loads(line)
+                        rec.setdefault("student_id", DEFAULT_STUDENT_ID)
+                        self.pending[self._key(rec)] = rec
+        if os.path.exists(failed_path):
+            with open(failed_path, encoding="utf-8") as f:
+                self.failed = sum(1 for line in f if line.strip())
+        if self.pending:
+            # 前回送れなかった行があれば、すぐに送信を再開する
+            self._start_worker()
+
+    @staticmethod
+    def _key(rec: dict) -> tuple:
+        return tuple(rec[k] for k in RESULT_KEY)
+
+    def _persist(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for rec in self.pending.values():
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+
+    def _start_worker(self):
+        """送るものができたときに、書き込み用のスレッドを1本だけ立てる（呼ぶときは cond を持つこと）"""
+        if self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        # キャッシュの更新で st.cache_resource を呼ぶので、呼び出したセッションの文脈を引き継ぐ
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            add_script_run_ctx(self.worker, ctx)
+        self.worker.start()
+
+    def enqueue(self, records: list):
+        with self.cond:
+            for rec in records:
+                self.pending[self._key(rec)] = rec
+            self.version += 1
+            self._persist()
+            self._start_worker()
+            self.cond.notify()
+
+    def _set_aside(self, batch: list):
+        """再送しても通らない行 [(キー, 行, エラー)] を取り置きのファイルへ足し、送信待ちから外す"""
+        failed_at = pd.Timestamp.now().isoformat(timespec="seconds")
+        lines = [json.dumps({"record": rec, "error": error, "failed_at": failed_at}, ensure_ascii=False)
+                 for _, rec, error in batch]
+        try:
+            with open(self.failed_path, "a", encoding="utf-8") as f:
+                f.writelines(line + "\n" for line in lines)
+        except OSError:
+            # ファイルに残せなくても、行の中身はログから拾えるようにしておく
+            logger.exception("取り置きのファイルに書けませんでした:\n%s", "\n".join(lines))
+            return
+        logger.error("保存できなかった %d 件を %s に取り置きました", len(batch), self.failed_path)
+
+    def _write_each(self, batch: list) -> tuple:
+        """1行ずつ送り、(書き込めた行, 送り終えたキー, 取り置いた [(キー, 行, エラー)], 一時的な失敗) を返す。
+
+        一時的な失敗が出たら、そこで切り分けをやめる（残りは送信待ちのまま再送する）。
+        """
+        written, done, rejected = [], set(), []
+        for key, rec in batch:
+            try:
+                written += get_storage().upsert_results([rec], RESULT_KEY)
+            except Exception as e:
+                if _write_error_kind(e) == "transient":
+                    return written, done, rejected, e
+                rejected.append((key, rec, repr(e)))
+            done.add(key)
+        return written, done, rejected, None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                if self.retry_at is not None:
+                    self.cond.wait(max(0.0, self.retry_at - time.monotonic()))
+                else:
+                    # 続けて押された保存を同じバッチに入れる
+                    self.cond.wait(WRITE_FLUSH_DELAY_SEC)
+                batch = list(self.pending.items())[:WRITE_BATCH_SIZE]
+            done, rejected, error = {key for key, _ in batch}, [], None
+            try:
+                with span("write_queue.flush", rows=len(batch)):
+                    written = get_storage().upsert_results([rec for _, rec in batch], RESULT_KEY)
+            except Exception as e:
+                kind = _write_error_kind(e)
+                if kind == "transient" or (kind == "unknown" and self.failures + 1 < WRITE_MAX_ATTEMPTS):
+                    self._retry_later(e)
+                    continue
+                # どの行が通らないのかを切り分ける
+                logger.warning("送信待ちの保存を1行ずつ送り直します", exc_info=True)
+                with span("write_queue.isolate", rows=len(batch)):
+                    written, done, rejected, error = self._write_each(batch)
+            _apply_written(written)
+            if rejected:
+                self._set_aside(rejected)
+            with self.cond:
+                # 送信中に同じキーが再び保存されていたら、新しい方を残す
+                for key, rec in batch:
+                    if key in done and self.pending.get(key) is rec:
+                        del self.pending[key]
+                self.version += 1
+                self._persist()
+                self.failed += len(rejected)
+                if error is None:
+                    self.failures = 0
+                    self.last_error = None
+                    self.retry_at = None
+                    self.last_flush = time.time()
+            if error is not None:
+                self._retry_later(error)
+
+    def _retry_later(self, error: Exception):
+        with self.cond:
+            self.failures += 1
+            self.last_error = repr(error)
+            delay = min(WRITE_RETRY_BASE_SEC * 2 ** (self.failures - 1), WRITE_RETRY_MAX_SEC)
+            self.retry_at = time.monotonic() + delay
+        logger.warning("送信待ちの保存の書き込みに失敗しました（%.0f 秒後に再送）", delay, exc_info=error)
+
+    def status(self) -> dict:
+        with self.cond:
+            return {
+                "pending": len(self.pending),
+                "failures": self.failures,
+                "failed": self.failed,
+                "last_error": self.last_error,
+                "last_flush": self.last_flush,
+                "retry_in": max(0.0, self.retry_at - time.monotonic()) if self.retry_at else None,
+            }
+
+    def records(self) -> list:
+        with self.cond:
+            return list(self.pending.values())
+
+    def flush(self, timeout: float = None) -> bool:
+        """送信待ちが無くなるまで待つ。timeout までに終われば True"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.cond:
+                if not self.pending:
+                    return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+
+
+@st.cache_resource
+def _write_queue() -> _WriteBehindQueue:
+    return _WriteBehindQueue(WRITE_QUEUE_PATH, WRITE_FAILED_PATH)
+
+
+def _queue_in_use() -> bool:
+    """キューを使う設定か、前回の送信待ちの控えが残っているか（どちらでもなければキューを作らない）"""
+    return WRITE_BEHIND or os.path.exists(WRITE_QUEUE_PATH)
+
+
+def enqueue_results(rows: list) -> int:
+    """保存をキューに入れてすぐ戻る。rows は upsert_results と同じ形式。受け付けた行数を返す"""
+    records = [_result_record(**row) for row in rows]
+    _write_queue().enqueue(records)
+    return len(records)
+
+
+def write_queue_status() -> dict:
+    """pending（送信待ち件数）/ failures（連続失敗回数）/ failed（取り置いた件数）/ last_error / last_flush / retry_in"""
+    return _write_queue().status()
+
+
+def flush_write_queue(timeout: float = None) -> bool:
+    return _write_queue().flush(timeout)
+
+
+def _overlay_pending(df: pd.DataFrame, records: list, filters: dict) -> pd.DataFrame:
+    pending = _filter_results(_results_frame(records),
+                              **{k: v for k, v in filters.items() if k not in ("columns", "order", "limit")})
+    if pending.empty:
+        return df[filters["columns"]] if filters["columns"] else df
+    key_of = lambda frame: pd.MultiIndex.from_frame(frame[RESULT_KEY].astype(str))
+    df_keys, pending_keys = key_of(df), key_of(pending)
+    hit = df_keys.isin(pending_keys)
+    # 既存の行の上書きは元の id を引き継ぎ、新規の行には負の id を振る
+    ids = dict(zip(df_keys[hit], df.loc[hit, "id"]))
+    pending["id"] = [ids.get(k, -(i + 1)) for i, k in enumerate(pending_keys)]
+    combined = _apply_schema(pd.concat([df[~hit], pending.reindex(columns=df.columns)], ignore_index=True),
+                             RESULT_SCHEMA)
+    return _filter_results(combined, columns=filters["columns"], order=filters["order"] or ["test_date"],
+                           limit=filters["limit"])
+
+
+# ─── 並列読み込み ──────────────────────────────────
+
+# load_datasets の既定のタイムアウト（秒）
+DATASET_TIMEOUT_SEC = float(get_setting("DATASET_TIMEOUT_SEC", 30))
+
+
+class DatasetLoadError(Exception):
+    """load_datasets で読み込めなかったデータセット"""
+
+    def __init__(self, name: str, error: BaseException):
+        super().__init__(f"{name} の読み込みに失敗しました: {error!r}")
+        self.name = name
+        self.error = error
+
+
+@st.cache_resource
+def _loader_pool() -> ThreadPoolExecutor:
+    # 再実行のたびにスレッドを作らないようプロセスで共有する
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="dataset-loader")
+
+
+def load_datasets(loaders: dict, timeout=None, raise_errors: bool = True) -> dict:
+    """ページが使うデータセットを並列に読み込む。
+
+    loaders は 名前 → 引数なしの関数。timeout は秒数か 名前 → 秒数 の dict。
+    戻り値は 名前 → 結果。読み込みに失敗したりタイムアウトしたデータセットは、
+    raise_errors=True なら DatasetLoadError を送出し、False なら結果の代わりに
+    DatasetLoadError を入れて返す。
+    """
+    ctx = get_script_run_ctx()
+
+    def run(fn):
+        # st.cache_* などがセッション外の警告を出さないようにする
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        return fn()
+
+    pool = _loader_pool()
+    started = time.monotonic()
+    futures = {
+        name: pool.submit(contextvars.copy_context().run, run, fn)
+        for name, fn in loaders.items()
+    }
+    results = {}
+    for name, future in futures.items():
+        limit = timeout.get(name) if isinstance(timeout, dict) else timeout
+        limit = DATASET_TIMEOUT_SEC if limit is None else limit
+        try:
+            results[name] = future.result(timeout=max(0.0, started + limit - time.monotonic()))
+        except FutureTimeoutError as e:
+            future.cancel()
+            results[name] = DatasetLoadError(name, TimeoutError(f"{limit} 秒以内に終わりませんでした"))
+            results[name].__cause__ = e
+        except Exception as e:
+            results[name] = DatasetLoadError(name, e)
+            results[name].__cause__ = e
+    if raise_errors:
+        for value in results.values():
+            if isinstance(value, DatasetLoadError):
+                raise value
+    return results
 
 
 # ─── 計算 ──────────────────────────────────────────
 
+def _round1(values: np.ndarray) -> np.ndarray:
+    """Python の round(x, 1) と同じ結果になるベクトル版の丸め"""
+    scaled = values * 10
+    out = np.rint(scaled) / 10
+    # 10倍した値がちょうど .5 になる要素だけは、np.rint と round() で
+    # 結果が分かれることがあるので round() に任せる
+    ties = np.abs(scaled - np.trunc(scaled)) == 0.5
+    if ties.any():
+        out[ties] = [round(float(v), 1) for v in values[ties]]
+    return out
+
+
+def _to_array(values) -> np.ndarray:
+    values = pd.to_numeric(pd.Series(values), errors="coerce")
+    arr = values.to_numpy(dtype="float64", na_value=np.nan)
+    if values.dtype == "float32":
+        # float32 で保持した 61.3 などを入力どおりの値に戻す（500 未満なら誤差は 5e-5 未満）
+        arr = np.round(arr, 4)
+    return arr
+
+
+def _rate_vec(value: np.ndarray, max_score: np.ndarray) -> np.ndarray:
+    valid = max_score > 0
+    out = np.full(len(value), np.nan)
+    out[valid] = _round1(value[valid] / max_score[valid] * 100)
+    return out
+
+
+def _relative_score_vec(score: np.ndarray, average_score: np.ndarray, max_score: np.ndarray) -> np.ndarray:
+    valid = max_score > 0
+    out = np.full(len(score), np.nan)
+    s, a, m = score[valid], average_score[valid], max_score[valid]
+    out[valid] = _round1((s / m - a / m) * 100 + 50)
+    return out
+
+
+def _deviation_vec(score: np.ndarray, average_score: np.ndarray, std_dev: np.ndarray) -> np.ndarray:
+    valid = std_dev > 0
+    out = np.full(len(score), np.nan)
+    s, a, sd = score[valid], average_score[valid], std_dev[valid]
+    out[valid] = _round1((s - a) / sd * 10 + 50)
+    return out
+
+
+def _scalar(values: np.ndarray):
+    v = values[0]
+    return None if np.isnan(v) else float(v)
+
+
 def calc_relative_score(score, average_score, max_score):
-    if max_score and float(max_score) > 0:
-        return round((float(score) / float(max_score) - float(average_score) / float(max_score)) * 100 + 50, 1)
-    return None
+    return _scalar(_relative_score_vec(_to_array([score]), _to_array([average_score]), _to_array([max_score])))
 
 
 def calc_deviation(score, average_score, std_dev):
-    if std_dev and float(std_dev) > 0:
-        return round((float(score) - float(average_score)) / float(std_dev) * 10 + 50, 1)
-    return None
+    return _scalar(_deviation_vec(_to_array([score]), _to_array([average_score]), _to_array([std_dev])))
 
 
+@traced("enrich_results")
 def enrich_results(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return df
     df = df.copy()
-    df["score_rate"] = df.apply(
-        lambda r: round(float(r["score"]) / float(r["max_score"]) * 100, 1)
-        if float(r["max_score"]) > 0 else None, axis=1
-    )
-    df["avg_rate"] = df.apply(
-        lambda r: round(float(r["average_score"]) / float(r["max_score"]) * 100, 1)
-        if float(r["max_score"]) > 0 else None, axis=1
-    )
-    df["relative_score"] = df.apply(
-        lambda r: calc_relative_score(r["score"], r["average_score"], r["max_score"]), axis=1
-    )
-    df["deviation"] = df.apply(
-        lambda r: calc_deviation(r["score"], r["average_score"], r.get("std_dev")), axis=1
-    )
+    score = _to_array(df["score"])
+    average_score = _to_array(df["average_score"])
+    max_score = _to_array(df["max_score"])
+    std_dev = _to_array(df["std_dev"]) if "std_dev" in df.columns else np.full(len(df), np.nan)
+    df["score_rate"] = _rate_vec(score, max_score)
+    df["avg_rate"] = _rate_vec(average_score, max_score)
+    df["relative_score"] = _relative_score_vec(score, average_score, max_score)
+    df["deviation"] = _deviation_vec(score, average_score, std_dev)
     return df
@@ -1,39 +1,48 @@
 import streamlit as st
-import sys, os
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from data_utils import SUBJECTS, LESSON_TYPES, upsert_result, load_results, get_units_for_test, load_units
-import datetime
-import pandas as pd
+import perf
+from bootstrap import deferred_imports, setup_page
 
-st.set_page_config(page_title="テスト結果入力", page_icon="✏️", layout="wide")
-st.markdown("""
-<style>
-h1 { font-size: 1.6rem !important; }
-</style>
-""", unsafe_allow_html=True)
+setup_page("テスト結果入力", "✏️", "✏️ テスト結果を入力する")
 
-st.title("✏️ テスト結果を入力する")
+# 骨組みを描いてから重いモジュールを読み込む
+with deferred_imports("1_入力"):
+    from data_utils import (SUBJECTS, LESSON_TYPES, WRITE_BEHIND, WRITE_FAILED_PATH, upsert_result, upsert_results, load_results,
+                            enqueue_results, write_queue_status, get_units_for_test, get_test_numbers,
+                            load_units, load_datasets, enrich_results, render_student_selector)
+    import datetime
+    import pandas as pd
 
-# 講座種別ごとの講義No.を取得
-units_df = load_units()
+render_student_selector()
+
+# 直近の入力データ（表示する列・件数だけ）
+RECENT_QUERY = dict(
+    columns=["lesson_type", "test_number", "subject", "score", "average_score", "max_score"],
+    order=["-lesson_type", "-test_number"],
+    limit=20,
+)
+
+# 単元マスタと直近の入力データを並列に読み込む
+data = load_datasets({
+    "units": load_units,
+    "recent": lambda: load_results(**RECENT_QUERY),
+})
+units_df = data["units"]
 
 col1, col2 = st.columns(2)
 with col1:
     lesson_type = st.selectbox("講座種別", LESSON_TYPES)
 with col2:
     if not units_df.empty:
-        available_numbers = sorted(
-            units_df[units_df["lesson_type"] == lesson_type]["test_number"].unique().tolist()
-        )
+        available_numbers = get_test_numbers(lesson_type)
     else:
         available_numbers = list(range(1, 45))
     test_number = st.selectbox("講義No.", available_numbers)
 
 st.divider()
 
-def save_subject(subject, score, avg, max_s, std_dev):
-    return upsert_result(
+def subject_row(subject, score, avg, max_s, std_dev):
+    return dict(
         test_date=datetime.date.today(),
         lesson_type=lesson_type,
         test_number=int(test_number),
@@ -45,7 +54,28 @@ def save_subject(subject, score, avg, max_s, std_dev):
         memo="",
     )
 
-for subject in SUBJECTS:
+def save_subject(subject, score, avg, max_s, std_dev):
+    row = subject_row(subject, score, avg, max_s, std_dev)
+    if WRITE_BEHIND:
+        enqueue_results([row])
+        return "queued"
+    return upsert_result(**row)
+
+SAVE_LABELS = {"saved": "✅ 保存！", "updated": "✅ 上書き保存！", "queued": "✅ 受け付けました"}
+
+def saved_and_rerun(key, message):
+    # 直近データの一覧にも反映するため、保存後はページ全体を再実行し、メッセージはその後に出す
+    st.session_state[f"flash_{key}"] = message
+    st.rerun()
+
+def show_flash(key):
+    message = st.session_state.pop(f"flash_{key}", None)
+    if message:
+        st.success(message)
+
+# 教科ごとのブロックは入力を変えてもそのブロックだけが再実行される
+@st.fragment
+def subject_block(subject, lesson_type, test_number):
     units_df_sub = get_units_for_test(subject, lesson_type, test_number)
 
     with st.expander(f"**{subject}**", expanded=True):
@@ -77,22 +107,73 @@ for subject in SUBJECTS:
             st.write("")
             if st.button("💾 保存", key=f"save_{subject}"):
                 result = save_subject(subject, score, avg, max_s, std if std > 0 else None)
-                if result == "saved":
-                    st.success("✅ 保存！")
-                elif result == "updated":
-                    st.success("✅ 上書き保存！")
+                saved_and_rerun(subject, SAVE_LABELS[result])
+        show_flash(subject)
+
+for subject in SUBJECTS:
+    subject_block(subject, lesson_type, test_number)
+
+# --- 入力した教科をまとめて保存（1回の通信で書き込む） ---
+# 得点も平均点も 0 のままの教科は未入力とみなして送らない（保存済みの結果を 0 で上書きしないため）
+def filled_subjects():
+    return [s for s in SUBJECTS
+            if st.session_state[f"score_{s}"] > 0 or st.session_state[f"avg_{s}"] > 0]
+
+if st.button("💾 入力した教科をまとめて保存", type="primary"):
+    subjects = filled_subjects()
+    rows = []
+    for subject in subjects:
+        std = st.session_state[f"std_{subject}"]
+        rows.append(subject_row(
+            subject,
+            st.session_state[f"score_{subject}"],
+            st.session_state[f"avg_{subject}"],
+            st.session_state[f"max_{subject}"],
+            std if std > 0 else None,
+        ))
+    skipped = [s for s in SUBJECTS if s not in subjects]
+    note = f"（未入力のため保存しなかった教科: {'・'.join(skipped)}）" if skipped else ""
+    if not rows:
+        st.warning("得点か平均点を入力した教科がありません。")
+    elif WRITE_BEHIND:
+        enqueue_results(rows)
+        saved_and_rerun("all", f"✅ {'・'.join(subjects)}の保存を受け付けました" + note)
+    else:
+        results = upsert_results(rows)
+        labels = {"saved": "保存", "updated": "上書き保存"}
+        saved_and_rerun("all", "✅ " + "　".join(f"{s}: {labels[r]}" for s, r in zip(subjects, results)) + note)
+show_flash("all")
 
 # --- 直近データ一覧 ---
-st.divider()
-st.subheader("📋 直近の入力データ")
-df = load_results()
-if not df.empty:
-    show = df.sort_values(["lesson_type", "test_number"], ascending=False).head(20).copy()
-    show["相対スコア"] = show.apply(
-        lambda r: round((r["score"]/r["max_score"] - r["average_score"]/r["max_score"])*100 + 50, 1), axis=1
-    )
-    show = show[["lesson_type","test_number","subject","score","average_score","max_score","相対スコア"]]
-    show.columns = ["講座","講義No.","教科","得点","平均点","満点","相対スコア"]
-    st.dataframe(show, use_container_width=True, hide_index=True)
-else:
-    st.info("まだデータがありません。")
+# 「更新」では一覧と送信待ちの状況だけを読み直す
+@st.fragment
+def recent_table(df):
+    st.divider()
+    c1, c2 = st.columns([5, 1])
+    c1.subheader("📋 直近の入力データ")
+    if c2.button("🔄 更新", key="refresh_recent"):
+        df = load_results(**RECENT_QUERY)
+
+    if WRITE_BEHIND:
+        status = write_queue_status()
+        if status["last_error"]:
+            st.warning(f"⚠️ 送信待ち {status['pending']} 件：書き込みに失敗したため"
+                       f"約 {status['retry_in'] or 0:.0f} 秒後に再送します（{status['last_error']}）")
+        elif status["pending"]:
+            st.caption(f"⏳ 送信待ち {status['pending']} 件")
+        if status["failed"]:
+            st.error(f"❌ 保存できなかった {status['failed']} 件を取り置いています（{WRITE_FAILED_PATH}）。"
+                     "内容を直して入力し直してください。")
+
+    if not df.empty:
+        show = df.copy()
+        show["相対スコア"] = enrich_results(show)["relative_score"]
+        show = show[["lesson_type","test_number","subject","score","average_score","max_score","相対スコア"]]
+        show.columns = ["講座","講義No.","教科","得点","平均点","満点","相対スコア"]
+        st.dataframe(show, use_container_width=True, hide_index=True)
+    else:
+        st.info("まだデータがありません。")
+
+recent_table(data["recent"])
+
+perf.render_panel()
@@ -1,74 +1,77 @@
 import streamlit as st
-import sys, os
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from data_utils import SUBJECTS, load_results, enrich_results
-import plotly.graph_objects as go
+import perf
+from bootstrap import deferred_imports, setup_page
 
-st.set_page_config(page_title="成績グラフ", page_icon="📈", layout="wide")
-st.markdown("""
-<style>
-h1 { font-size: 1.6rem !important; }
-</style>
-""", unsafe_allow_html=True)
+setup_page("成績グラフ", "📈", "📈 成績グラフ")
 
-st.title("📈 成績グラフ")
+# 骨組みを描いてから重いモジュールを読み込む
+with deferred_imports("2_グラフ"):
+    from data_utils import SUBJECTS, LESSON_TYPES, load_results, enrich_results, results_version, render_student_selector
+    from charts import build_trend_figures, plotly_chart, x_labels
+    from cohort import COHORT_MIN_SIZE, get_cohort_ranking, with_cohort_metrics
+    from analytics import REVIEW_THRESHOLD, TREND_WINDOW, get_trend_analytics
+    import pandas as pd
 
-df_raw = load_results()
-if df_raw.empty:
-    st.info("まだデータがありません。「✏️ テスト結果を入力する」からデータを登録してください。")
-    st.stop()
-
-df = enrich_results(df_raw)
+render_student_selector()
 
 # --- サイドバー ---
 with st.sidebar:
     st.header("表示設定")
     y_metric = st.radio(
         "指標",
-        ["相対スコア（平均=50）", "得点率（%）", "得点（点）"],
+        ["相対スコア（平均=50）", "得点率（%）", "得点（点）", "クラス内偏差値", "クラス内パーセンタイル"],
         help="相対スコア：平均得点率を50として自分の得点率との差を加算。平均より上なら50超、下なら50未満。"
+             "クラス内偏差値・パーセンタイルは、アプリに登録された生徒の得点から回ごとに求めます"
+             "（選んだときだけクラス全体の結果を読み込みます）。"
     )
-    lesson_types = df["lesson_type"].unique().tolist()
-    selected_types = st.multiselect("講座種別", lesson_types, default=lesson_types)
+    selected_types = st.multiselect("講座種別", LESSON_TYPES, default=LESSON_TYPES)
     show_avg_line = st.checkbox("平均ラインを表示", value=True)
 
+# 選んだ講座種別の、グラフに使う列だけを読み込む
+df_raw = load_results(
+    lesson_type=selected_types,
+    columns=["id", "test_date", "lesson_type", "test_number", "subject", "score", "average_score", "max_score"],
+)
+if df_raw.empty:
+    st.info("まだデータがありません。「✏️ テスト結果を入力する」からデータを登録してください。")
+    st.stop()
+
+# 直近の平均・指数平滑・単元ごとの苦手度も、保存された行の分だけ差分更新される
+analytics = get_trend_analytics()
+trends = analytics.subject_trends().set_index("subject")
+
 metric_map = {
     "相対スコア（平均=50）": ("relative_score", "相対スコア"),
     "得点率（%）": ("score_rate", "得点率 (%)"),
     "得点（点）": ("score", "得点 (点)"),
+    "クラス内偏差値": ("cohort_deviation", "クラス内偏差値"),
+    "クラス内パーセンタイル": ("percentile", "パーセンタイル"),
 }
 y_col, y_label = metric_map[y_metric]
+cohort_metric = y_col in ("cohort_deviation", "percentile")
 
-df = df[df["lesson_type"].isin(selected_types)].copy()
-df["x_label"] = df.apply(lambda r: f"{r['lesson_type']} 第{int(r['test_number'])}回", axis=1)
+df = enrich_results(df_raw)
+if cohort_metric:
+    # クラス内の指標を選んだときだけ全生徒の結果を同期する（順位は保存のたびに差分更新される）
+    ranking = get_cohort_ranking()
+    df = with_cohort_metrics(df, ranking=ranking)
+df["x_label"] = x_labels(df)
 df = df.sort_values(["test_date", "test_number"])
 
-COLORS = {"国語": "#EF4444", "算数": "#3B82F6", "理科": "#10B981", "社会": "#F59E0B"}
+# 図は データの版 × 表示設定 ごとにキャッシュされる
+version = (results_version(df_raw), ranking.version) if cohort_metric else results_version(df_raw)
+figures = build_trend_figures(df, version, y_col, y_label,
+                              tuple(selected_types), show_avg_line)
 
 # --- 全教科まとめ ---
 st.subheader("全教科の推移")
-fig_all = go.Figure()
-for subject in SUBJECTS:
-    sub = df[df["subject"] == subject]
-    if sub.empty:
-        continue
-    fig_all.add_trace(go.Scatter(
-        x=sub["x_label"], y=sub[y_col],
-        mode="lines+markers", name=subject,
-        line=dict(color=COLORS[subject], width=2),
-        marker=dict(size=9),
-        hovertemplate=f"<b>{subject}</b><br>%{{x}}<br>{y_label}: %{{y}}<extra></extra>"
-    ))
-if y_col == "relative_score" and show_avg_line:
-    fig_all.add_hline(y=50, line_dash="dot", line_color="gray", annotation_text="平均(50)")
-fig_all.update_layout(
-    height=380, hovermode="x unified",
-    yaxis_title=y_label, xaxis_title="",
-    legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
-    margin=dict(t=30, b=10),
-)
-st.plotly_chart(fig_all, use_container_width=True)
+# クラス内の指標は、受けた生徒が足りない回を描かない
+no_points = f"{y_label}を出せる回がまだありません（受けた生徒が{COHORT_MIN_SIZE}人以上の回だけ表示します）。"
+if figures["all"]["data"]:
+    plotly_chart(figures["all"], use_container_width=True)
+else:
+    st.info(no_points)
 
 st.divider()
 
@@ -82,54 +85,55 @@ for tab, subject in zip(tabs, SUBJECTS):
             st.info(f"{subject}のデータがまだありません。")
             continue
 
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(
-            x=sub["x_label"], y=sub[y_col],
-            mode="lines+markers", name=subject,
-            line=dict(color=COLORS[subject], width=3),
-            marker=dict(size=11),
-            hovertemplate=f"<b>{subject}</b><br>%{{x}}<br>{y_label}: %{{y}}<br>得点: %{{customdata[0]}} / %{{customdata[1]}}<extra></extra>",
-            customdata=sub[["score", "max_score"]].values,
-        ))
-
-        # 平均ラインを得点率・得点モードで追加
-        if show_avg_line and y_col == "score_rate":
-            fig.add_trace(go.Scatter(
-                x=sub["x_label"], y=sub["avg_rate"],
-                mode="lines+markers", name="平均",
-                line=dict(color="#9CA3AF", width=2, dash="dash"),
-                marker=dict(size=7),
-            ))
-        elif show_avg_line and y_col == "score":
-            fig.add_trace(go.Scatter(
-                x=sub["x_label"], y=sub["average_score"],
-                mode="lines+markers", name="平均",
-                line=dict(color="#9CA3AF", width=2, dash="dash"),
-                marker=dict(size=7),
-            ))
-        elif y_col == "relative_score" and show_avg_line:
-            fig.add_hline(y=50, line_dash="dot", line_color="gray", annotation_text="平均(50)")
-
         # 最新の統計
         latest = sub.iloc[-1]
-        m1, m2, m3 = st.columns(3)
+        m1, m2, m3, m4 = st.columns(4)
         m1.metric("最新得点率", f"{latest['score_rate']:.1f}%",
                   delta=f"{latest['score_rate'] - sub.iloc[-2]['score_rate']:.1f}pt" if len(sub) > 1 else None)
         m2.metric("最新相対スコア", f"{latest['relative_score']:.1f}",
                   delta=f"{latest['relative_score'] - sub.iloc[-2]['relative_score']:.1f}" if len(sub) > 1 else None)
         avg_rs = sub["relative_score"].mean()
         m3.metric("平均相対スコア（全回）", f"{avg_rs:.1f}")
-
-        fig.update_layout(
-            height=320, hovermode="x unified",
-            yaxis_title=y_label, xaxis_title="",
-            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
-            margin=dict(t=30, b=10),
-        )
-        st.plotly_chart(fig, use_container_width=True)
+        if cohort_metric and pd.notna(latest["cohort_deviation"]):
+            m4.metric("最新クラス内偏差値", f"{latest['cohort_deviation']:.1f}",
+                      help=f"{int(latest['cohort_n'])}人中 {int(latest['cohort_rank'])}位"
+                           f"（パーセンタイル {latest['percentile']:.1f}）")
+        if subject in trends.index:
+            t = trends.loc[subject]
+            t1, t2, _, _ = st.columns(4)
+            t1.metric(f"直近{TREND_WINDOW}回の平均相対スコア", f"{t['rolling_mean']:.1f}",
+                      delta=f"{t['rolling_mean'] - t['prev_rolling_mean']:.1f}" if pd.notna(t["prev_rolling_mean"]) else None,
+                      help="講座種別の選択にかかわらず、すべての回から求めます。")
+            t2.metric("傾向（指数平滑）", f"{t['ewm']:.1f}",
+                      delta=f"{t['ewm'] - t['prev_ewm']:.1f}" if pd.notna(t["prev_ewm"]) else None,
+                      help="新しい回ほど重くした相対スコアの平均です。上向きなら調子が上がっています。")
+
+        if subject in figures:
+            plotly_chart(figures[subject], use_container_width=True)
+        else:
+            st.info(no_points)
 
         # 全データ表示
         with st.expander("データ一覧"):
-            disp = sub[["x_label","test_date","score","average_score","max_score","score_rate","relative_score"]].copy()
-            disp.columns = ["回","日付","得点","平均点","満点","得点率(%)","相対スコア"]
+            columns = {"x_label": "回", "test_date": "日付", "score": "得点", "average_score": "平均点",
+                       "max_score": "満点", "score_rate": "得点率(%)", "relative_score": "相対スコア"}
+            if cohort_metric:
+                columns.update(cohort_mean="クラス平均", cohort_rank="クラス内順位", cohort_n="人数",
+                               percentile="パーセンタイル", cohort_deviation="クラス内偏差値")
+            disp = sub[list(columns)].rename(columns=columns)
             st.dataframe(disp, use_container_width=True, hide_index=True)
+
+# --- 復習したい単元 ---
+st.divider()
+st.subheader("📌 復習したい単元")
+st.caption("都道府県①〜④のような続きの単元は講座をまたいでまとめ、相対スコアの平均が低い順に並べています。"
+           "受けた回数が少ない単元は平均(50)寄りに評価されます。")
+review = analytics.units_to_review(REVIEW_THRESHOLD, limit=10)
+if review.empty:
+    st.success("平均を下回っている単元はありません。")
+else:
+    review_display = review[["subject", "unit_group", "count", "avg_relative", "review_score"]].round(1)
+    review_display.columns = ["教科", "単元", "回数", "平均相対スコア", "復習の目安"]
+    st.dataframe(review_display, use_container_width=True, hide_index=True)
+
+perf.render_panel()
@@ -1,17 +1,14 @@
 import streamlit as st
-import sys, os
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from data_utils import SUBJECTS, LESSON_TYPES, load_units
+import perf
+from bootstrap import deferred_imports, setup_page
 
-st.set_page_config(page_title="単元一覧", page_icon="📋", layout="wide")
-st.markdown("""
-<style>
-h1 { font-size: 1.6rem !important; }
-</style>
-""", unsafe_allow_html=True)
+setup_page("単元一覧", "📋", "📋 単元一覧")
+
+# 骨組みを描いてから重いモジュールを読み込む
+with deferred_imports("3_単元一覧"):
+    from data_utils import SUBJECTS, LESSON_TYPES, load_units
 
-st.title("📋 単元一覧")
 st.caption("画像から取り込んだ単元データです。テスト結果入力時にも参照されます。")
 
 units_df = load_units()
@@ -58,3 +55,5 @@ for tab, subject in zip(tabs, subjects_to_show):
 
 st.divider()
 st.caption(f"総単元数: {len(units_df)} 件（社会44＋国語44＋算数44＋理科44＋各講習）")
+
+perf.render_panel()
@@ -1,46 +1,38 @@
 import streamlit as st
-import sys, os
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from data_utils import SUBJECTS, load_results, load_units, enrich_results
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+import perf
+from bootstrap import deferred_imports, setup_page
 
-st.set_page_config(page_title="苦手分析", page_icon="🔍", layout="wide")
-st.markdown("""
-<style>
-h1 { font-size: 1.6rem !important; }
-</style>
-""", unsafe_allow_html=True)
+setup_page("苦手分析", "🔍", "🔍 苦手単元を分析する")
 
-st.title("🔍 苦手単元を分析する")
+# 骨組みを描いてから重いモジュールを読み込む
+with deferred_imports("4_苦手分析"):
+    from data_utils import SUBJECTS, load_results, load_datasets, render_student_selector
+    from weakness import get_weakness_aggregates
+    from cohort import COHORT_MIN_SIZE, get_cohort_ranking, with_cohort_metrics
+    from analytics import REVIEW_THRESHOLD, get_trend_analytics
+    from charts import plotly_chart
+    import pandas as pd
+    import plotly.graph_objects as go
 
-df_raw = load_results()
-units_df = load_units()
+render_student_selector()
+
+# 結果と、単元付きの結果・教科別平均の集計、単元のまとめごとの集計
+# （どれも保存のたびに差分更新）を並列に用意する
+data = load_datasets({"results": load_results, "weakness": get_weakness_aggregates,
+                      "analytics": get_trend_analytics})
+df_raw = data["results"]
 
 if df_raw.empty:
     st.info("まだデータがありません。テスト結果を入力すると分析できるようになります。")
     st.stop()
 
-df = enrich_results(df_raw)
-
-# 単元と結果をマージ
-merged = pd.merge(
-    df,
-    units_df,
-    on=["subject", "lesson_type", "test_number"],
-    how="left"
-)
+agg = data["weakness"]
+analytics = data["analytics"]
 
 # --- 教科別の相対スコア平均 ---
 st.subheader("📊 教科別 平均相対スコア")
-subj_stats = df.groupby("subject").agg(
-    avg_relative=("relative_score", "mean"),
-    avg_score_rate=("score_rate", "mean"),
-    count=("score", "count")
-).reset_index()
-subj_stats = subj_stats.sort_values("avg_relative")
+subj_stats = agg.subject_stats()
 
 COLORS = {"国語": "#EF4444", "算数": "#3B82F6", "理科": "#10B981", "社会": "#F59E0B"}
 fig_bar = go.Figure()
@@ -56,24 +48,68 @@ fig_bar.update_layout(
     height=300, yaxis_title="平均相対スコア", xaxis_title="",
     margin=dict(t=20, b=10), yaxis_range=[30, 70],
 )
-st.plotly_chart(fig_bar, use_container_width=True)
+plotly_chart(fig_bar, use_container_width=True)
 
-# --- 苦手回次ランキング ---
-st.divider()
-st.subheader("⚠️ 相対スコアが低かった回（苦手候補）")
+# --- クラス内の位置 ---
+# 全生徒の結果の同期が要るので、開いたときだけ求める（切り替えてもこの部分だけが再実行される）
+@st.fragment
+def cohort_positions(df_raw):
+    st.subheader("🏫 教科別 クラス内の位置")
+    if not st.toggle("クラス内の位置を表示", help="アプリに登録された生徒全員の結果を読み込みます。"):
+        return
+    st.caption("アプリに登録された生徒の得点から回ごとに求めた、クラス内偏差値とパーセンタイルの平均です。")
+    positions = with_cohort_metrics(df_raw[["id", "subject"]], ranking=get_cohort_ranking())
+    positions = positions[positions["cohort_deviation"].notna()]
+    if positions.empty:
+        st.info(f"比べられる回がまだありません（受けた生徒が{COHORT_MIN_SIZE}人以上の回だけ求めます）。")
+        return
+    pos = positions.groupby("subject", observed=True).agg(
+        deviation=("cohort_deviation", "mean"), percentile=("percentile", "mean"), count=("id", "count"),
+    )
+    cols = st.columns(len(pos))
+    for col, (subject, row) in zip(cols, pos.iterrows()):
+        col.metric(f"{subject}（{int(row['count'])}回）", f"偏差値 {row['deviation']:.1f}",
+                   help=f"平均パーセンタイル {row['percentile']:.1f}")
 
-threshold = st.slider("この相対スコア未満を苦手とみなす", min_value=30, max_value=55, value=48, step=1)
+cohort_positions(df_raw)
 
-weak = merged[merged["relative_score"] < threshold].copy()
-if weak.empty:
-    st.success(f"相対スコア{threshold}未満の回はありません！好調です 🎉")
+# --- 復習したい単元 ---
+st.subheader("📌 復習したい単元")
+st.caption("都道府県①〜④のような続きの単元は講座をまたいでまとめ、複数の単元を扱った回はそれぞれの単元に数えます。"
+           "受けた回数が少ない単元は平均(50)寄りに評価されます。")
+review = analytics.units_to_review(REVIEW_THRESHOLD)
+if review.empty:
+    st.success("平均を下回っている単元はありません。")
 else:
+    review_display = review[["subject", "unit_group", "count", "avg_relative", "review_score"]].round(1)
+    review_display.columns = ["教科", "単元", "回数", "平均相対スコア", "復習の目安"]
+    st.dataframe(review_display, use_container_width=True, hide_index=True, height=min(420, 38 + 35 * len(review)))
+
+# --- 苦手回次ランキング ---
+# スライダーを動かすと苦手回の一覧とマップ（苦手ライン）だけ、
+# 教科の選択を変えるとマップだけが再実行される
+@st.fragment
+def weak_section(agg):
+    st.divider()
+    st.subheader("⚠️ 相対スコアが低かった回（苦手候補）")
+
+    threshold = st.slider("この相対スコア未満を苦手とみなす", min_value=30, max_value=55, value=48, step=1)
+
+    weak = agg.weak_tests(threshold)
+    if weak.empty:
+        st.success(f"相対スコア{threshold}未満の回はありません！好調です 🎉")
+    else:
+        weak_table(weak)
+    subject_map(agg, threshold)
+
+def weak_table(weak):
+    # パーセンタイルは、並んだ回の結果だけをクラス全体から読み込んで求める
+    weak = with_cohort_metrics(weak)
     weak_display = weak[[
         "subject", "lesson_type", "test_number", "unit_name", "content",
-        "score", "average_score", "max_score", "relative_score", "test_date"
+        "score", "average_score", "max_score", "relative_score", "percentile", "test_date"
     ]].copy()
-    weak_display = weak_display.sort_values("relative_score")
-    weak_display.columns = ["教科","講座","回","単元名","学習内容","得点","平均点","満点","相対スコア","日付"]
+    weak_display.columns = ["教科","講座","回","単元名","学習内容","得点","平均点","満点","相対スコア","パーセンタイル","日付"]
 
     # 教科ごとにタブ表示
     tab_subjects = weak_display["教科"].unique().tolist()
@@ -84,14 +120,16 @@ else:
             st.dataframe(sub_weak, use_container_width=True, hide_index=True)
 
 # --- 単元別ヒートマップ（データが多い場合） ---
-st.divider()
-st.subheader("📈 教科別 回次スコア推移マップ")
-selected_subject = st.selectbox("教科を選択", SUBJECTS)
+@st.fragment
+def subject_map(agg, threshold):
+    st.divider()
+    st.subheader("📈 教科別 回次スコア推移マップ")
+    selected_subject = st.selectbox("教科を選択", SUBJECTS)
 
-sub_df = merged[merged["subject"] == selected_subject].sort_values(["lesson_type","test_number"])
-if sub_df.empty:
-    st.info("データなし")
-else:
+    sub_df = agg.subject_tests(selected_subject).sort_values(["lesson_type","test_number"])
+    if sub_df.empty:
+        st.info("データなし")
+        return
     sub_df["label"] = sub_df.apply(
         lambda r: f"{r['lesson_type']} 第{int(r['test_number'])}回\n{r['unit_name'] if pd.notna(r['unit_name']) else ''}",
         axis=1
@@ -117,5 +155,9 @@ else:
         margin=dict(t=20, b=10),
         xaxis_tickangle=-45,
     )
-    st.plotly_chart(fig2, use_container_width=True)
+    plotly_chart(fig2, use_container_width=True)
     st.caption("🔴 赤 = 苦手ライン未満　🟢 緑 = 平均以上")
+
+weak_section(agg)
+
+perf.render_panel()
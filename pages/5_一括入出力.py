@@ -0,0 +1,68 @@
+import streamlit as st
+
+import perf
+from bootstrap import deferred_imports, setup_page
+
+setup_page("一括入出力", "📦", "📦 テスト結果の一括入出力")
+
+# 骨組みを描いてから重いモジュールを読み込む
+with deferred_imports("5_一括入出力"):
+    from bulk_io import REQUIRED_COLUMNS, OPTIONAL_COLUMNS, export_csv_bytes, import_results
+    from data_utils import add_students, render_student_selector
+    import pandas as pd
+
+student_id = render_student_selector()
+
+# --- 生徒の登録 ---
+with st.expander("👤 生徒を登録する"):
+    c1, c2, c3 = st.columns([2, 2, 1])
+    new_id = c1.text_input("生徒ID", help="URL の ?student= やファイルの student_id 列で使う値")
+    new_name = c2.text_input("名前")
+    c3.write("")
+    c3.write("")
+    if c3.button("登録") and new_id.strip():
+        add_students([{"student_id": new_id.strip(), "name": new_name.strip() or new_id.strip()}])
+        st.success(f"✅ {new_name or new_id} を登録しました")
+
+# --- 取り込み ---
+st.subheader("📥 CSV / Excel から取り込む")
+st.caption(
+    f"必須の列: {', '.join(REQUIRED_COLUMNS)}（任意: {', '.join(OPTIONAL_COLUMNS)}）。"
+    "「日付」「講座」「講義No.」「教科」「得点」「平均点」「満点」などの見出しでも取り込めます。"
+    "student_id（生徒）の列が無い・空の行は、サイドバーで選んでいる生徒の結果として取り込みます。"
+    "同じ生徒・講座・講義No.・教科の行は後の行で上書きします。"
+)
+uploaded = st.file_uploader("ファイルを選択", type=["csv", "xlsx"])
+dry_run = st.checkbox("検証だけ行う（書き込まない）", value=False)
+
+if uploaded is not None and st.button("📥 取り込む", type="primary"):
+    progress = st.empty()
+    try:
+        report = import_results(
+            uploaded, name=uploaded.name, dry_run=dry_run, student_id=student_id,
+            on_progress=lambda r: progress.caption(f"{r.read:,} 行読み込み…"),
+        )
+    except (ValueError, RuntimeError) as e:
+        st.error(str(e))
+    else:
+        progress.empty()
+        label = "検証しました" if dry_run else "取り込みました"
+        st.success(f"✅ {label}：書き込み {report.written:,} 行（読み込み {report.read:,} 行・"
+                   f"重複 {report.duplicates:,} 行・不正 {report.invalid:,} 行）")
+        if report.errors:
+            errors = pd.DataFrame(report.errors, columns=["行", "理由"])
+            st.warning("取り込めなかった行があります。")
+            st.dataframe(errors, use_container_width=True, hide_index=True)
+
+# --- 書き出し ---
+st.divider()
+st.subheader("📤 CSV に書き出す")
+st.caption("大量のデータを Parquet で書き出す場合は `python bulk_io.py export results.parquet` を使ってください。")
+scope = st.radio("書き出す範囲", ["選んでいる生徒", "クラス全体"], horizontal=True)
+if st.button("📤 CSV を作成"):
+    st.session_state["export_csv"] = export_csv_bytes(student_id if scope == "選んでいる生徒" else None)
+if "export_csv" in st.session_state:
+    st.download_button("⬇️ ダウンロード", data=st.session_state["export_csv"],
+                       file_name="test_results.csv", mime="text/csv")
+
+perf.render_panel()
@@ -0,0 +1,174 @@
+"""処理時間の計測。
+
+ストレージ呼び出しや重い計算を span() / traced() で囲むと、所要時間・行数・
+データ量をプロセス共通のリングバッファに記録する。ロガー "juku.perf" を INFO 以上に
+すると1件ごとに JSON で出力される。PERF_PANEL 設定か URL の ?perf=1 で、
+サイドバーに今回の再実行の内訳を表示する。
+"""
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import streamlit as st
+
+from settings import get_setting
+
+logger = logging.getLogger("juku.perf")
+
+BUFFER_SIZE = int(get_setting("PERF_BUFFER_SIZE", 5000))
+_buffer = deque(maxlen=BUFFER_SIZE)
+_rerun = contextvars.ContextVar("juku_perf_rerun", default=None)
+_rerun_started = contextvars.ContextVar("juku_perf_rerun_started", default=None)
+
+
+def _payload(result):
+    """戻り値から (行数, バイト数) をざっと求める"""
+    if hasattr(result, "memory_usage") and hasattr(result, "columns"):
+        return len(result), int(result.memory_usage(index=False).sum())
+    if isinstance(result, list):
+        if not result:
+            return 0, 0
+        # 全件を直列化すると重いので、先頭行の JSON サイズ × 行数で見積もる
+        return len(result), len(json.dumps(result[0], default=str).encode()) * len(result)
+    return None, None
+
+
+class Span:
+    __slots__ = ("name", "attrs", "rows", "bytes")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.rows = None
+        self.bytes = None
+
+    def measure(self, result):
+        """戻り値の行数とデータ量を記録してそのまま返す"""
+        self.rows, self.bytes = _payload(result)
+        return result
+
+
+def _record(s: Span, seconds: float):
+    rec = {
+        "ts": time.time(),
+        "rerun": _rerun.get(),
+        "name": s.name,
+        "ms": round(seconds * 1000, 3),
+        "rows": s.rows,
+        "bytes": s.bytes,
+        "thread": threading.current_thread().name,
+        **s.attrs,
+    }
+    _buffer.append(rec)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(rec, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(name: str, **attrs):
+    s = Span(name, attrs)
+    start = time.perf_counter()
+    try:
+        yield s
+    finally:
+        _record(s, time.perf_counter() - start)
+
+
+def traced(name: str = None):
+    """関数呼び出しを span で囲むデコレーター（ジェネレーターには使わない）"""
+    def decorator(fn):
+        label = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(label) as s:
+                return s.measure(fn(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+class TracedStorage:
+    """StorageBackend の公開メソッド呼び出しをすべて計測するラッパー"""
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        return traced(f"storage.{name}")(attr)
+
+
+# ─── 再実行単位の集計 ──────────────────────────────
+
+def begin_rerun():
+    """ページの先頭で呼ぶ。以降の記録に今回の再実行 id が付く"""
+    _rerun.set(uuid.uuid4().hex[:12])
+    _rerun_started.set(time.perf_counter())
+
+
+def current_spans() -> list:
+    rerun = _rerun.get()
+    return [r for r in list(_buffer) if rerun is not None and r["rerun"] == rerun]
+
+
+def export_spans() -> list:
+    return list(_buffer)
+
+
+def export_jsonl() -> str:
+    return "\n".join(json.dumps(r, ensure_ascii=False, default=str) for r in export_spans())
+
+
+# render_panel に表として出す累計カウンター（見出し → {行: {列: 値}} を返す関数）
+_counters = {}
+
+
+def register_counters(title: str, fn):
+    _counters[title] = fn
+
+
+def panel_enabled() -> bool:
+    if str(get_setting("PERF_PANEL", "")).lower() in ("1", "true", "yes"):
+        return True
+    return st.query_params.get("perf") == "1"
+
+
+def render_panel():
+    """ページの最後で呼ぶ。有効なときだけサイドバーに今回の内訳を表示する"""
+    if not panel_enabled():
+        return
+    import pandas as pd
+
+    started = _rerun_started.get()
+    spans = current_spans()
+    with st.sidebar.expander("⏱ 処理時間（今回の再実行）", expanded=True):
+        if started is not None:
+            st.caption(f"ページ全体: {(time.perf_counter() - started) * 1000:.0f} ms"
+                       "（入れ子の計測は重複して数えられます）")
+        if spans:
+            df = pd.DataFrame(spans)
+            summary = df.groupby("name").agg(
+                回数=("name", "size"),
+                合計ms=("ms", "sum"),
+                最大ms=("ms", "max"),
+                行数=("rows", "sum"),
+                バイト=("bytes", "sum"),
+            ).sort_values("合計ms", ascending=False)
+            st.dataframe(summary.round(1), use_container_width=True)
+        else:
+            st.caption("記録なし")
+        for title, fn in list(_counters.items()):
+            counts = fn()
+            if counts:
+                st.caption(title)
+                st.dataframe(pd.DataFrame.from_dict(counts, orient="index"), use_container_width=True)
+        st.download_button("計測ログ（JSON Lines）", data=export_jsonl(),
+                           file_name="perf.jsonl", mime="application/json")
@@ -0,0 +1,255 @@
+"""生徒ごとの成績レポートの一括作成（保護者向けの月次レポートなど）。
+
+    python reports.py reports/2026-09 [--from 2026-09-01] [--to 2026-09-30] [--student ID ...]
+                      [--format html parquet png] [--workers 8] [--threshold 48]
+
+クラス全体の結果を1回だけ読み、クラス内の順位を付けてから生徒ごとに分け、
+プロセスプールで並列に「相対スコアの推移（全教科・教科別）」「苦手候補の回」
+「教科別の平均」を作って out_dir/<student_id>/ に書き出す。単元マスタは各プロセスの
+起動時に1回だけ渡し、以後は読み取り専用で共有する。
+
+  html     report.html（グラフは out_dir/plotly.min.js を読む。オフラインで見られる）
+  parquet  results.parquet（単元名・相対スコア・クラス内順位付きの結果）と weak_tests.parquet
+  png      教科別グラフの画像（kaleido が必要）
+
+out_dir/index.html に生徒の一覧を書く。
+"""
+import argparse
+import html
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
+from plotly.offline import get_plotlyjs
+
+from charts import CHART_MAX_POINTS, _build_trend_figures, x_labels
+from cohort import COHORT_COLUMNS, CohortRanking
+from data_utils import SUBJECTS, current_units, iter_results, list_students, enrich_results
+from weakness import WeaknessAggregates
+
+REPORT_FORMATS = ["html", "parquet", "png"]
+DEFAULT_FORMATS = ["html", "parquet"]
+
+# 苦手分析ページのスライダーの初期値と同じ
+WEAK_THRESHOLD = 48
+
+# 保護者向けの表に出す列（表示名）
+WEAK_COLUMNS = {
+    "subject": "教科", "lesson_type": "講座", "test_number": "回", "unit_name": "単元名",
+    "score": "得点", "average_score": "平均点", "max_score": "満点",
+    "relative_score": "相対スコア", "percentile": "パーセンタイル", "test_date": "日付",
+}
+SUBJECT_COLUMNS = {"subject": "教科", "avg_relative": "平均相対スコア", "avg_score_rate": "平均得点率(%)",
+                   "count": "回数"}
+
+
+# ─── 1人分のレポート（子プロセスで動く） ───
+
+# 子プロセスの起動時に _init_worker で入る（単元マスタ, 内容ハッシュ, 出力先, 形式, 苦手ライン）
+_worker = {}
+
+
+def _init_worker(units: pd.DataFrame, units_version: str, out_dir: str, formats: list, threshold: float):
+    _worker.update(units=units, units_version=units_version, out_dir=out_dir,
+                   formats=formats, threshold=threshold)
+
+
+def _safe_name(student_id: str) -> str:
+    return re.sub(r"[^\w.-]", "_", str(student_id)) or "_"
+
+
+def _table_html(df: pd.DataFrame, columns: dict) -> str:
+    out = df[list(columns)].rename(columns=columns)
+    if "日付" in out.columns:
+        out["日付"] = pd.to_datetime(out["日付"]).dt.strftime("%Y-%m-%d")
+    return out.to_html(index=False, na_rep="", float_format=lambda v: f"{v:.1f}", border=0)
+
+
+def _page(title: str, body: str, script: str = None) -> str:
+    head = f'<script src="{script}"></script>' if script else ""
+    return f"""<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><title>{html.escape(title)}</title>{head}
+<style>
+body {{ font-family: sans-serif; margin: 2rem auto; max-width: 960px; color: #111827; }}
+h1 {{ font-size: 1.6rem; }} h2 {{ font-size: 1.2rem; margin-top: 2rem; }}
+table {{ border-collapse: collapse; font-size: 0.9rem; }}
+th, td {{ border-bottom: 1px solid #E5E7EB; padding: 0.3rem 0.6rem; text-align: right; }}
+th {{ background: #F9FAFB; }}
+</style></head>
+<body>{body}</body></html>
+"""
+
+
+def _student_report(student_id: str, name: str, rows: pd.DataFrame) -> dict:
+    """1人分のレポートを書き出し、一覧用の要約を返す"""
+    out_dir = os.path.join(_worker["out_dir"], _safe_name(student_id))
+    os.makedirs(out_dir, exist_ok=True)
+    formats, threshold = _worker["formats"], _worker["threshold"]
+
+    df = enrich_results(rows).sort_values(["test_date", "test_number"]).reset_index(drop=True)
+    df["x_label"] = x_labels(df)
+    # 苦手分析ページと同じ集計（単元名付き・相対スコア昇順）
+    agg = WeaknessAggregates(_worker["units"], _worker["units_version"])
+    agg.on_reset(rows)
+    weak = agg.weak_tests(threshold)
+    stats = agg.subject_stats()
+    figures = _build_trend_figures(df, "relative_score", "相対スコア", True, CHART_MAX_POINTS)
+
+    if "html" in formats:
+        parts = [f"<h1>{html.escape(name)} さんの成績レポート</h1>",
+                 f"<p>{df['test_date'].min():%Y-%m-%d} 〜 {df['test_date'].max():%Y-%m-%d}"
+                 f"（{len(df)} 件）</p>",
+                 "<h2>教科別の平均</h2>", _table_html(stats, SUBJECT_COLUMNS),
+                 "<h2>相対スコアの推移</h2>",
+                 pio.to_html(go.Figure(figures["all"]), full_html=False, include_plotlyjs=False)]
+        for subject in SUBJECTS:
+            if subject in figures:
+                parts += [f"<h2>{subject}</h2>",
+                          pio.to_html(go.Figure(figures[subject]), full_html=False, include_plotlyjs=False)]
+        parts += [f"<h2>相対スコアが {threshold:g} 未満だった回（苦手候補）</h2>",
+                  _table_html(weak, WEAK_COLUMNS) if not weak.empty else "<p>ありません。</p>"]
+        with open(os.path.join(out_dir, "report.html"), "w", encoding="utf-8") as f:
+            f.write(_page(f"{name} 成績レポート", "\n".join(parts), script="../plotly.min.js"))
+    if "parquet" in formats:
+        export = df.drop(columns=["x_label"]).merge(_worker["units"], on=["subject", "lesson_type", "test_number"],
+                                                    how="left")
+        for frame, file in ((export, "results.parquet"), (weak, "weak_tests.parquet")):
+            frame = frame.astype({c: str for c in frame.columns if isinstance(frame[c].dtype, pd.CategoricalDtype)})
+            frame.to_parquet(os.path.join(out_dir, file), index=False)
+    if "png" in formats:
+        for subject in SUBJECTS:
+            if subject in figures:
+                pio.write_image(figures[subject], os.path.join(out_dir, f"{subject}.png"), width=960, height=320)
+
+    latest = df["test_date"].max()
+    return {
+        "student_id": student_id, "name": name, "count": len(df),
+        "avg_relative": float(df["relative_score"].mean()),
+        "weak": len(weak), "last_test": latest, "dir": _safe_name(student_id),
+    }
+
+
+# ─── まとめて作る ───
+
+def _check_formats(formats: list):
+    unknown = set(formats) - set(REPORT_FORMATS)
+    if unknown:
+        raise ValueError(f"未対応の形式です: {', '.join(sorted(unknown))}（{' / '.join(REPORT_FORMATS)}）")
+    try:
+        if "parquet" in formats:
+            import pyarrow  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError("Parquet で書き出すには pyarrow が必要です（pip install pyarrow）") from e
+    try:
+        if "png" in formats:
+            import kaleido  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError("PNG で書き出すには kaleido が必要です（pip install kaleido）") from e
+
+
+def _load_class_results(student_ids, date_from, date_to, page_size, fetch_workers) -> pd.DataFrame:
+    """クラス全体の結果にクラス内の順位を付け、期間と生徒で絞る"""
+    frames = [c for c in iter_results(page_size=page_size, max_workers=fetch_workers) if not c.empty]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    # 順位は期間で絞る前の全員分から求める（回ごとなので期間の影響は受けない）
+    ranking = CohortRanking()
+    ranking.on_reset(df)
+    df = df.merge(ranking.rows[["id"] + COHORT_COLUMNS], on="id", how="left")
+    keep = pd.Series(True, index=df.index)
+    if student_ids:
+        keep &= df["student_id"].isin(student_ids)
+    if date_from is not None:
+        keep &= df["test_date"] >= pd.Timestamp(date_from)
+    if date_to is not None:
+        keep &= df["test_date"] <= pd.Timestamp(date_to)
+    return df[keep]
+
+
+def _write_index(out_dir: str, summary: pd.DataFrame, threshold: float):
+    rows = "\n".join(
+        f'<tr><td style="text-align:left"><a href="{html.escape(r.dir)}/report.html">{html.escape(r.name)}</a></td>'
+        f"<td>{r.count}</td><td>{r.avg_relative:.1f}</td><td>{r.weak}</td><td>{r.last_test:%Y-%m-%d}</td></tr>"
+        for r in summary.itertuples()
+    )
+    body = ("<h1>成績レポート一覧</h1>"
+            f"<table><tr><th>生徒</th><th>件数</th><th>平均相対スコア</th>"
+            f"<th>苦手候補（{threshold:g} 未満）</th><th>最終受験日</th></tr>\n{rows}</table>")
+    with open(os.path.join(out_dir, "index.html"), "w", encoding="utf-8") as f:
+        f.write(_page("成績レポート一覧", body))
+
+
+def generate_reports(out_dir: str, student_ids=None, date_from=None, date_to=None,
+                     formats=None, threshold: float = WEAK_THRESHOLD, max_workers: int = None,
+                     page_size: int = None, fetch_workers: int = None, on_progress=None) -> pd.DataFrame:
+    """生徒ごとのレポートを out_dir に書き出し、生徒ごとの要約（student_id 順）を返す。
+
+    student_ids を省略すると結果のある全員。期間内に結果が無い生徒のレポートは作らない。
+    on_progress(済んだ人数, 全体の人数) を渡すと1人終わるたびに呼ばれる。
+    """
+    formats = list(formats or DEFAULT_FORMATS)
+    _check_formats(formats)
+    df = _load_class_results(student_ids, date_from, date_to, page_size, fetch_workers)
+    if df.empty:
+        return pd.DataFrame()
+
+    os.makedirs(out_dir, exist_ok=True)
+    if "html" in formats:
+        with open(os.path.join(out_dir, "plotly.min.js"), "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+
+    names = list_students().set_index("student_id")["name"]
+    units, version = current_units()
+    groups = list(df.groupby(df["student_id"].astype(str), sort=True))
+    summaries = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(units, version, out_dir, formats, threshold)) as pool:
+        futures = [pool.submit(_student_report, sid, names.get(sid, sid), rows.reset_index(drop=True))
+                   for sid, rows in groups]
+        for f in as_completed(futures):
+            summaries.append(f.result())
+            if on_progress:
+                on_progress(len(summaries), len(futures))
+
+    summary = pd.DataFrame(summaries).sort_values("student_id").reset_index(drop=True)
+    _write_index(out_dir, summary, threshold)
+    return summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="生徒ごとの成績レポートを一括で作る")
+    parser.add_argument("out_dir")
+    parser.add_argument("--from", dest="date_from", help="この日以降の結果だけ（YYYY-MM-DD）")
+    parser.add_argument("--to", dest="date_to", help="この日までの結果だけ（YYYY-MM-DD）")
+    parser.add_argument("--student", nargs="+", help="作る生徒（省略すると結果のある全員）")
+    parser.add_argument("--format", nargs="+", default=DEFAULT_FORMATS, choices=REPORT_FORMATS)
+    parser.add_argument("--threshold", type=float, default=WEAK_THRESHOLD, help="苦手とみなす相対スコア")
+    parser.add_argument("--workers", type=int, help="レポートを作るプロセス数（既定は CPU 数）")
+    parser.add_argument("--page-size", type=int)
+    parser.add_argument("--fetch-workers", type=int)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    summary = generate_reports(
+        args.out_dir, student_ids=args.student, date_from=args.date_from, date_to=args.date_to,
+        formats=args.format, threshold=args.threshold, max_workers=args.workers,
+        page_size=args.page_size, fetch_workers=args.fetch_workers,
+        on_progress=lambda done, total: print(f"\r{done:,} / {total:,} 人", end="", file=sys.stderr),
+    )
+    print(file=sys.stderr)
+    if summary.empty:
+        print("対象の結果がありません。")
+        return 1
+    print(f"{len(summary):,} 人分のレポートを書き出しました（{time.perf_counter() - started:.1f} 秒）: "
+          f"{os.path.join(args.out_dir, 'index.html')}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
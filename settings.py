@@ -0,0 +1,15 @@
+import os
+
+import streamlit as st
+
+
+def get_setting(name: str, default=None):
+    """設定値を 環境変数 JUKU_<name> → st.secrets[name] → default の順に探す"""
+    env = os.environ.get(f"JUKU_{name}")
+    if env is not None:
+        return env
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        # secrets.toml が無い環境（ローカルの SQLite 運用やベンチマーク）
+        return default
@@ -0,0 +1,371 @@
+import csv
+import datetime
+import os
+import sqlite3
+import threading
+
+import streamlit as st
+
+from perf import TracedStorage
+from settings import get_setting
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+UNITS_CSV = os.path.join(BASE_DIR, "data", "units.csv")
+
+# student_id を持たない既存データ・入力の生徒
+DEFAULT_STUDENT_ID = get_setting("DEFAULT_STUDENT_ID", "default")
+
+UNIT_FIELDS = ["subject", "lesson_type", "test_number", "unit_name", "content"]
+STUDENT_FIELDS = ["student_id", "name"]
+RESULT_FIELDS = [
+    "student_id", "test_date", "lesson_type", "test_number", "subject",
+    "score", "average_score", "max_score", "std_dev", "memo",
+]
+RESULT_SELECTABLE = set(RESULT_FIELDS) | {"id", "updated_at"}
+
+
+def _as_list(value):
+    if value is None:
+        return None
+    return [value] if isinstance(value, (str, int)) else list(value)
+
+
+def _in_filters(subject, lesson_type, student_id, test_number):
+    """query_results の「列 in (値...)」条件を (列, 値のリスト) で返す"""
+    pairs = [("student_id", _as_list(student_id)), ("lesson_type", _as_list(lesson_type)),
+             ("test_number", None if test_number is None else [int(n) for n in _as_list(test_number)]),
+             ("subject", _as_list(subject))]
+    return [(col, value) for col, value in pairs if value is not None]
+
+
+def _check_columns(columns):
+    unknown = [c.lstrip("-") for c in columns or [] if c.lstrip("-") not in RESULT_SELECTABLE]
+    if unknown:
+        raise ValueError(f"test_results に無い列です: {unknown}")
+
+
+class StorageBackend:
+    """単元マスタとテスト結果の読み書き先。
+
+    test_results の行は dict で受け渡し、id（自動採番）と
+    updated_at（ISO 8601 文字列）を持つ。結果を読むメソッドの student_id は
+    1つの値または値のリストで、None ならすべての生徒。
+    """
+
+    def fetch_units(self) -> list:
+        raise NotImplementedError
+
+    def fetch_students(self) -> list:
+        raise NotImplementedError
+
+    def upsert_students(self, records: list):
+        raise NotImplementedError
+
+    def fetch_results(self, after_id: int, limit: int, upper_id: int = None,
+                      since_id: int = None, updated_since: str = None, student_id=None) -> list:
+        """id > after_id（かつ id <= upper_id）の行を id 昇順で最大 limit 行返す。
+
+        updated_since を渡した場合は「id > since_id または
+        updated_at > updated_since」の行に絞る。
+        """
+        raise NotImplementedError
+
+    def max_result_id(self):
+        raise NotImplementedError
+
+    def query_results(self, subject=None, lesson_type=None, date_from=None, date_to=None,
+                      columns=None, order=None, limit=None, student_id=None, test_number=None) -> list:
+        """条件に合う行だけをサーバー側で絞り込んで返す。
+
+        subject / lesson_type / student_id / test_number は1つの値または値のリスト。
+        order は列名のリストで、先頭に "-" を付けると降順。
+        """
+        raise NotImplementedError
+
+    def insert_results(self, records: list) -> list:
+        raise NotImplementedError
+
+    def upsert_results(self, records: list, key: list) -> list:
+        """key の列が一致する行は上書き、無ければ追加し、書き込んだ行を返す"""
+        raise NotImplementedError
+
+    def delete_results(self, ids: list):
+        raise NotImplementedError
+
+
+# ─── Supabase ─────────────────────────────────────
+
+class SupabaseBackend(StorageBackend):
+
+    def __init__(self, url: str, key: str):
+        from supabase import create_client
+        self.client = create_client(url, key)
+
+    def fetch_units(self) -> list:
+        return self.client.table("units").select("*").execute().data or []
+
+    def fetch_students(self) -> list:
+        return self.client.table("students").select("*").order("student_id").execute().data or []
+
+    def upsert_students(self, records):
+        self.client.table("students").upsert(records, on_conflict="student_id").execute()
+
+    def fetch_results(self, after_id, limit, upper_id=None, since_id=None, updated_since=None,
+                      student_id=None) -> list:
+        q = self.client.table("test_results").select("*").gt("id", after_id)
+        if student_id is not None:
+            q = q.in_("student_id", _as_list(student_id))
+        if upper_id is not None:
+            q = q.lte("id", upper_id)
+        if updated_since is not None:
+            q = q.or_(f'id.gt.{since_id},updated_at.gt."{updated_since}"')
+        return q.order("id").limit(limit).execute().data or []
+
+    def max_result_id(self):
+        top = self.client.table("test_results").select("id").order("id", desc=True).limit(1).execute().data
+        return int(top[0]["id"]) if top else None
+
+    def query_results(self, subject=None, lesson_type=None, date_from=None, date_to=None,
+                      columns=None, order=None, limit=None, student_id=None, test_number=None,
+                      page_size=1000) -> list:
+        _check_columns(columns)
+        _check_columns(order)
+
+        def build(offset, n):
+            q = self.client.table("test_results").select(",".join(columns) if columns else "*")
+            for col, value in _in_filters(subject, lesson_type, student_id, test_number):
+                q = q.in_(col, value)
+            if date_from is not None:
+                q = q.gte("test_date", str(date_from))
+            if date_to is not None:
+                q = q.lte("test_date", str(date_to))
+            for col in list(order or []) + ["id"]:
+                q = q.order(col.lstrip("-"), desc=col.startswith("-"))
+            return q.range(offset, offset + n - 1)
+
+        # max-rows で切られないよう page_size 行ずつ取る
+        rows = []
+        while limit is None or len(rows) < limit:
+            n = page_size if limit is None else min(page_size, limit - len(rows))
+            page = build(len(rows), n).execute().data or []
+            rows += page
+            if len(page) < n:
+                break
+        return rows
+
+    def insert_results(self, records) -> list:
+        return self.client.table("test_results").insert(records).execute().data or []
+
+    def upsert_results(self, records, key) -> list:
+        return self.client.table("test_results").upsert(records, on_conflict=",".join(key)).execute().data or []
+
+    def delete_results(self, ids):
+        self.client.table("test_results").delete().in_("id", list(ids)).execute()
+
+
+# ─── SQLite（ローカル） ───────────────────────────
+
+_SQLITE_SCHEMA = """
+create table if not exists units (
+    subject text not null,
+    lesson_type text not null,
+    test_number integer not null,
+    unit_name text,
+    content text
+);
+create index if not exists units_key on units (subject, lesson_type, test_number);
+create index if not exists units_lesson on units (lesson_type, test_number);
+
+create table if not exists students (
+    student_id text primary key,
+    name text
+);
+
+create table if not exists test_results (
+    id integer primary key autoincrement,
+    student_id text not null,
+    test_date text not null,
+    lesson_type text not null,
+    test_number integer not null,
+    subject text not null,
+    score real not null,
+    average_score real not null,
+    max_score real not null,
+    std_dev real,
+    memo text default '',
+    updated_at text not null,
+    unique (student_id, lesson_type, test_number, subject)
+);
+create index if not exists test_results_updated on test_results (updated_at);
+create index if not exists test_results_date on test_results (test_date);
+create index if not exists test_results_student on test_results (student_id, id);
+create index if not exists test_results_test on test_results (lesson_type, test_number, subject);
+"""
+
+# student_id が無かった頃の test_results を作り直すための SQL（既存行は DEFAULT_STUDENT_ID に入れる）
+_SQLITE_MIGRATE_STUDENT = """
+alter table test_results rename to test_results_v1;
+drop index if exists test_results_updated;
+drop index if exists test_results_date;
+"""
+
+
+class SQLiteBackend(StorageBackend):
+    """1台構成やベンチマーク用のローカル DB。単元マスタは units.csv から初期投入する"""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self._last_stamp = ""
+        with self.lock, self.conn:
+            if path != ":memory:":
+                self.conn.execute("pragma journal_mode=wal")
+            migrate = self._needs_student_migration()
+            if migrate:
+                self.conn.executescript(_SQLITE_MIGRATE_STUDENT)
+            self.conn.executescript(_SQLITE_SCHEMA)
+            if migrate:
+                cols = ", ".join(c for c in RESULT_FIELDS + ["id", "updated_at"] if c != "student_id")
+                self.conn.execute(f"insert into test_results (student_id, {cols}) "
+                                  f"select ?, {cols} from test_results_v1", [DEFAULT_STUDENT_ID])
+                self.conn.execute("drop table test_results_v1")
+            if self.conn.execute("select count(*) from units").fetchone()[0] == 0:
+                self._seed_units()
+            self.conn.execute("insert or ignore into students (student_id, name) values (?, ?)",
+                              [DEFAULT_STUDENT_ID, DEFAULT_STUDENT_ID])
+
+    def _needs_student_migration(self) -> bool:
+        cols = [r[1] for r in self.conn.execute("pragma table_info(test_results)").fetchall()]
+        return bool(cols) and "student_id" not in cols
+
+    def _seed_units(self):
+        if not os.path.exists(UNITS_CSV):
+            return
+        with open(UNITS_CSV, encoding="utf-8") as f:
+            rows = [tuple(r[c] for c in UNIT_FIELDS) for r in csv.DictReader(f)]
+        self.conn.executemany(
+            f"insert into units ({', '.join(UNIT_FIELDS)}) values (?, ?, ?, ?, ?)", rows
+        )
+
+    def _stamp(self) -> str:
+        # 差分同期が取りこぼさないよう、同じ時刻でも必ず前回より大きい値にする
+        stamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="microseconds")
+        if stamp <= self._last_stamp:
+            last = datetime.datetime.fromisoformat(self._last_stamp)
+            stamp = (last + datetime.timedelta(microseconds=1)).isoformat(timespec="microseconds")
+        self._last_stamp = stamp
+        return stamp
+
+    def _query(self, sql, params=()) -> list:
+        with self.lock:
+            return [dict(r) for r in self.conn.execute(sql, params).fetchall()]
+
+    def fetch_units(self) -> list:
+        return self._query("select * from units")
+
+    def fetch_students(self) -> list:
+        return self._query("select * from students order by student_id")
+
+    def upsert_students(self, records):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert into students (student_id, name) values (?, ?) "
+                "on conflict (student_id) do update set name = excluded.name",
+                [(r["student_id"], r.get("name") or r["student_id"]) for r in records],
+            )
+
+    def fetch_results(self, after_id, limit, upper_id=None, since_id=None, updated_since=None,
+                      student_id=None) -> list:
+        sql = "select * from test_results where id > ?"
+        params = [after_id]
+        if student_id is not None:
+            ids = _as_list(student_id)
+            sql += f" and student_id in ({', '.join('?' * len(ids))})"
+            params += ids
+        if upper_id is not None:
+            sql += " and id <= ?"
+            params.append(upper_id)
+        if updated_since is not None:
+            sql += " and (id > ? or updated_at > ?)"
+            params += [since_id, updated_since]
+        sql += " order by id limit ?"
+        params.append(limit)
+        return self._query(sql, params)
+
+    def max_result_id(self):
+        return self._query("select max(id) as id from test_results")[0]["id"]
+
+    def query_results(self, subject=None, lesson_type=None, date_from=None, date_to=None,
+                      columns=None, order=None, limit=None, student_id=None, test_number=None) -> list:
+        _check_columns(columns)
+        _check_columns(order)
+        where, params = [], []
+        for col, value in _in_filters(subject, lesson_type, student_id, test_number):
+            where.append(f"{col} in ({', '.join('?' * len(value))})")
+            params += value
+        if date_from is not None:
+            where.append("test_date >= ?")
+            params.append(str(date_from))
+        if date_to is not None:
+            where.append("test_date <= ?")
+            params.append(str(date_to))
+        sql = f"select {', '.join(columns) if columns else '*'} from test_results"
+        if where:
+            sql += " where " + " and ".join(where)
+        sql += " order by " + ", ".join(
+            f"{c.lstrip('-')} {'desc' if c.startswith('-') else 'asc'}" for c in list(order or []) + ["id"]
+        )
+        if limit is not None:
+            sql += " limit ?"
+            params.append(int(limit))
+        return self._query(sql, params)
+
+    def _select_ids(self, ids) -> list:
+        marks = ", ".join("?" * len(ids))
+        return [dict(r) for r in self.conn.execute(
+            f"select * from test_results where id in ({marks}) order by id", list(ids)
+        ).fetchall()]
+
+    def insert_results(self, records) -> list:
+        cols = RESULT_FIELDS + ["updated_at"]
+        sql = f"insert into test_results ({', '.join(cols)}) values ({', '.join('?' * len(cols))})"
+        with self.lock, self.conn:
+            ids = [
+                self.conn.execute(sql, [r.get(c) for c in RESULT_FIELDS] + [self._stamp()]).lastrowid
+                for r in records
+            ]
+            return self._select_ids(ids)
+
+    def upsert_results(self, records, key) -> list:
+        cols = RESULT_FIELDS + ["updated_at"]
+        updates = ", ".join(f"{c} = excluded.{c}" for c in cols if c not in key)
+        sql = (
+            f"insert into test_results ({', '.join(cols)}) values ({', '.join('?' * len(cols))}) "
+            f"on conflict ({', '.join(key)}) do update set {updates} returning id"
+        )
+        with self.lock, self.conn:
+            ids = [
+                self.conn.execute(sql, [r.get(c) for c in RESULT_FIELDS] + [self._stamp()]).fetchone()[0]
+                for r in records
+            ]
+            return self._select_ids(ids)
+
+    def delete_results(self, ids):
+        ids = list(ids)
+        with self.lock, self.conn:
+            self.conn.execute(f"delete from test_results where id in ({', '.join('?' * len(ids))})", ids)
+
+
+@st.cache_resource
+def get_storage() -> StorageBackend:
+    """STORAGE_BACKEND（"supabase" / "sqlite"）で読み書き先を切り替える"""
+    kind = get_setting("STORAGE_BACKEND", "supabase")
+    if kind == "sqlite":
+        backend = SQLiteBackend(get_setting("SQLITE_PATH", os.path.join(BASE_DIR, "data", "juku.sqlite3")))
+    elif kind == "supabase":
+        backend = SupabaseBackend(get_setting("SUPABASE_URL"), get_setting("SUPABASE_KEY"))
+    else:
+        raise ValueError(f"未対応の STORAGE_BACKEND です: {kind}")
+    # すべての呼び出しの所要時間・行数を perf に記録する
+    return TracedStorage(backend)
@@ -0,0 +1,105 @@
+"""差分更新する集計（推移・苦手分析・クラス内順位）が、全件から作り直した結果と一致するか。
+
+結果キャッシュが送る通知（on_merge / on_drop）を乱数で並べて流し、
+最後の表で on_reset したものと比べる。
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_utils
+from analytics import TrendAnalytics
+from bench.synthetic import make_results
+from cohort import COHORT_COLUMNS, CohortRanking
+from weakness import WeaknessAggregates
+
+STEPS = 40
+
+
+def _results(n: int, seed: int, students: int = None) -> pd.DataFrame:
+    return data_utils._apply_schema(make_results(n, seed=seed, students=students), data_utils.RESULT_SCHEMA)
+
+
+def _replay(listener, raw: pd.DataFrame, start: int, seed: int) -> pd.DataFrame:
+    """raw の先頭 start 行で on_reset し、追加・差し替え・削除を乱数で送る。最後の表を返す"""
+    rng = np.random.default_rng(seed)
+    current = raw.iloc[:start]
+    listener.on_reset(current.reset_index(drop=True))
+    unseen = raw.iloc[start:]
+    for _ in range(STEPS):
+        kind = rng.choice(["add", "replace", "drop", "mixed"])
+        if kind == "drop":
+            ids = current["id"].sample(int(rng.integers(1, 4)), random_state=rng).to_numpy()
+            listener.on_drop(ids)
+            current = current[~current["id"].isin(ids)]
+            continue
+        new = []
+        if kind in ("add", "mixed") and not unseen.empty:
+            # 時系列の途中に入る行も混ざる（日付は乱数）
+            k = int(rng.integers(1, 6))
+            new.append(unseen.iloc[:k])
+            unseen = unseen.iloc[k:]
+        if kind in ("replace", "mixed"):
+            old = current.sample(int(rng.integers(1, 4)), random_state=rng)
+            new.append(old.assign(score=(old["score"] * rng.uniform(0.3, 1.2)).round().astype("float32")))
+        if not new:
+            continue
+        new = pd.concat(new, ignore_index=True)
+        listener.on_merge(new)
+        current = pd.concat([current[~current["id"].isin(new["id"])], new], ignore_index=True)
+    return current.sort_values(["test_date", "id"]).reset_index(drop=True)
+
+
+def _by_id(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+    return df.sort_values("id")[["id"] + columns].reset_index(drop=True)
+
+
+@pytest.fixture(scope="module")
+def units():
+    return data_utils.load_units()
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_trend_analytics_matches_rebuild(units, seed):
+    raw = _results(600, seed)
+    incremental = TrendAnalytics(units)
+    final = _replay(incremental, raw, 400, seed)
+    rebuilt = TrendAnalytics(units)
+    rebuilt.on_reset(final)
+
+    a, b = incremental.trend.reset_index(drop=True), rebuilt.trend.reset_index(drop=True)
+    assert a["id"].tolist() == b["id"].tolist()
+    for col in ["relative_score", "rolling_mean", "ewm"]:
+        np.testing.assert_allclose(a[col], b[col], rtol=1e-9, err_msg=col)
+
+    review = incremental.units_to_review(100).merge(rebuilt.units_to_review(100), on=["subject", "unit_group"])
+    assert len(review) == len(rebuilt.units_to_review(100))
+    assert (review["count_x"] == review["count_y"]).all()
+    np.testing.assert_allclose(review["review_score_x"], review["review_score_y"])
+    pd.testing.assert_frame_equal(incremental.subject_trends(), rebuilt.subject_trends())
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_weakness_aggregates_match_rebuild(units, seed):
+    raw = _results(600, seed)
+    incremental = WeaknessAggregates(units)
+    final = _replay(incremental, raw, 400, seed)
+    rebuilt = WeaknessAggregates(units)
+    rebuilt.on_reset(final)
+
+    columns = ["subject", "lesson_type", "test_number", "unit_name", "score", "relative_score"]
+    pd.testing.assert_frame_equal(_by_id(incremental.tests, columns), _by_id(rebuilt.tests, columns))
+    assert incremental.tests["relative_score"].is_monotonic_increasing
+    pd.testing.assert_frame_equal(incremental.subject_stats(), rebuilt.subject_stats())
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_cohort_ranking_matches_rebuild(seed):
+    raw = _results(1200, seed, students=6)
+    incremental = CohortRanking()
+    final = _replay(incremental, raw, 900, seed)
+    rebuilt = CohortRanking()
+    rebuilt.on_reset(final)
+
+    pd.testing.assert_frame_equal(_by_id(incremental.rows, COHORT_COLUMNS), _by_id(rebuilt.rows, COHORT_COLUMNS))
+    pd.testing.assert_frame_equal(incremental.test_stats(), rebuilt.test_stats())
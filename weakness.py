@@ -0,0 +1,129 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from data_utils import UNIT_COLUMNS, current_student, current_units, enrich_results, subscribe_results
+from perf import traced
+
+UNIT_KEY = ["subject", "lesson_type", "test_number"]
+METRIC_COLUMNS = ["score_rate", "avg_rate", "relative_score", "deviation"]
+
+
+class WeaknessAggregates:
+    """苦手分析ページ用の集計。結果キャッシュの変更通知で差分更新する。
+
+    tests は結果に単元名を付けた表で、常に relative_score 昇順（欠損は末尾）。
+    totals は教科ごとの合計と件数で、平均はここから求める。
+    """
+
+    def __init__(self, units_df: pd.DataFrame, units_version: str = None):
+        self.lock = threading.Lock()
+        self.units = units_df
+        self.units_version = units_version
+        self.tests = None
+        self.totals = None
+
+    def set_units(self, units_df: pd.DataFrame, units_version: str):
+        """単元マスタが変わったときに単元名を付け直す（成績の集計はそのまま）"""
+        with self.lock:
+            self.units, self.units_version = units_df, units_version
+            if self.tests is not None:
+                unit_only = [c for c in UNIT_COLUMNS if c not in UNIT_KEY]
+                base = self.tests.drop(columns=unit_only).drop_duplicates("id")
+                self.tests = self._sorted(pd.merge(base, units_df, on=UNIT_KEY, how="left"))
+
+    def _joined(self, rows: pd.DataFrame) -> pd.DataFrame:
+        df = enrich_results(rows)
+        if df.empty:
+            df = df.reindex(columns=list(df.columns) + METRIC_COLUMNS)
+        return pd.merge(df, self.units, on=UNIT_KEY, how="left")
+
+    @staticmethod
+    def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+        return df.sort_values("relative_score", kind="stable", na_position="last").reset_index(drop=True)
+
+    @staticmethod
+    def _totals(df: pd.DataFrame) -> pd.DataFrame:
+        g = df.drop_duplicates("id").groupby("subject", observed=True)
+        return pd.DataFrame({
+            "rel_sum": g["relative_score"].sum(),
+            "rel_n": g["relative_score"].count(),
+            "rate_sum": g["score_rate"].sum(),
+            "rate_n": g["score_rate"].count(),
+            "count": g["score"].count(),
+        })
+
+    def _remove(self, ids):
+        gone = self.tests["id"].isin(ids)
+        if gone.any():
+            self.totals = self.totals.sub(self._totals(self.tests[gone]), fill_value=0)
+            self.tests = self.tests[~gone].reset_index(drop=True)
+
+    # ─── 結果キャッシュからの通知 ───
+
+    @traced("weakness.on_reset")
+    def on_reset(self, frame: pd.DataFrame):
+        with self.lock:
+            self.tests = self._sorted(self._joined(frame))
+            self.totals = self._totals(self.tests)
+
+    @traced("weakness.on_merge")
+    def on_merge(self, new: pd.DataFrame):
+        with self.lock:
+            if self.tests is None:
+                return
+            self._remove(new["id"])
+            add = self._sorted(self._joined(new))
+            # 全体を並べ直さず、二分探索した位置に差し込む
+            pos = np.searchsorted(self.tests["relative_score"].to_numpy(dtype="float64"),
+                                  add["relative_score"].to_numpy(dtype="float64"), side="right")
+            order = np.insert(np.arange(len(self.tests)), pos, np.arange(len(add)) + len(self.tests))
+            self.tests = pd.concat([self.tests, add], ignore_index=True).iloc[order].reset_index(drop=True)
+            self.totals = self.totals.add(self._totals(add), fill_value=0)
+
+    def on_drop(self, ids):
+        with self.lock:
+            if self.tests is not None:
+                self._remove(ids)
+
+    # ─── 読み出し ───
+
+    def subject_stats(self) -> pd.DataFrame:
+        """教科別の平均相対スコア・平均得点率・件数（平均相対スコア昇順）"""
+        with self.lock:
+            t = self.totals[self.totals["count"] > 0]
+        stats = pd.DataFrame({
+            "subject": t.index,
+            "avg_relative": (t["rel_sum"] / t["rel_n"].where(t["rel_n"] > 0)).to_numpy(),
+            "avg_score_rate": (t["rate_sum"] / t["rate_n"].where(t["rate_n"] > 0)).to_numpy(),
+            "count": t["count"].astype(int).to_numpy(),
+        })
+        return stats.sort_values("avg_relative").reset_index(drop=True)
+
+    def weak_tests(self, threshold: float) -> pd.DataFrame:
+        """relative_score が threshold 未満の回（relative_score 昇順）"""
+        with self.lock:
+            n = np.searchsorted(self.tests["relative_score"].to_numpy(dtype="float64"), threshold, side="left")
+            return self.tests.iloc[:n].copy()
+
+    def subject_tests(self, subject: str) -> pd.DataFrame:
+        with self.lock:
+            return self.tests[self.tests["subject"] == subject].copy()
+
+
+@st.cache_resource
+def _weakness_aggregates(student_id: str) -> WeaknessAggregates:
+    agg = WeaknessAggregates(*current_units())
+    subscribe_results(agg, student_id)
+    return agg
+
+
+def get_weakness_aggregates(student_id: str = None) -> WeaknessAggregates:
+    """生徒（省略時はこのセッションの生徒）の集計"""
+    agg = _weakness_aggregates(student_id or current_student())
+    units, version = current_units()
+    if version != agg.units_version:
+        agg.set_units(units, version)
+    return agg